@@ -1,8 +1,13 @@
+from collections import OrderedDict
 from contextlib import contextmanager
+import functools
+import hashlib
 import io
 import os
 import pathlib
-from typing import IO, Iterator, NamedTuple
+import random
+import tempfile
+from typing import IO, Iterator, MutableMapping, NamedTuple
 
 from pakal.archive import BaseArchive, make_opener, ArchiveIndex, ArchivePath
 
@@ -10,7 +15,7 @@ from rnc_deco import RncDecoder
 import rnccs
 
 
-def load_file(data_disk_handle, file_info):
+def load_file(data_disk_handle, file_info, verify=0.0):
 
     offset, size, flags = file_info
 
@@ -25,38 +30,131 @@ def load_file(data_disk_handle, file_info):
     if uncompressed or not ((READ_LE_UINT16(file_header) >> 7) & 1):
         return content
 
-    print("File is RNC compressed.")
-
     decomp_size = (READ_LE_UINT16(file_header) & 0xFF00) << 8
     decomp_size |= READ_LE_UINT16(file_header[12:14])
 
-    input_data = content[22:]
-    unpacked = bytearray(decomp_size)
-    decoded_size = RncDecoder().unpackM1(input_data, size - 22, unpacked)
-    decoded = bytes(rnccs.decompress(input_data))
+    # Unpack straight into the buffer that is returned, after the file
+    # header when it is part of the file.
+    decoded = bytearray(decomp_size)
+    output = memoryview(decoded)
+    if not (flags >> 22) & 0x1:  # do we include the header?
+        output[:22] = file_header
+        output = output[22:]
 
-    print(decoded_size)
+    input_data = memoryview(content)[22:]
+    decoded_size = rnccs.decompress_into(input_data, output)
 
-    if not decoded:  # Unpack returned 0: file was probably not packed.
-        print('Actually... it\'s not')
+    if not decoded_size:  # Unpack returned 0: file was probably not packed.
         return content
 
-    decoded2 = bytes(unpacked)
-    # assert a + b'\0' * (decomp_size - len(a)) == b, b[len(a):]
+    # `verify` is the fraction of entries to also decode with RncDecoder,
+    # e.g. 1 to check every entry of a new build or 0.05 to spot-check.
+    if verify and random.random() < verify:
+        cross_check(input_data, output[:decoded_size], decomp_size)
+
+    assert decoded_size == len(output), (decoded_size, len(output))
+
+    return decoded
+
+
+def cross_check(input_data, decoded, decomp_size):
+    if bytes(input_data[:4]) != b'RNC\x01':  # RncDecoder only has method 1
+        return
+    unpacked = bytearray(decomp_size)
+    decoded_size = RncDecoder().unpackM1(input_data, len(input_data), unpacked)
+    assert decoded_size > 0, decoded_size
 
+    decoded2 = bytes(unpacked)
     assert decoded2.startswith(decoded), (decoded, decoded2)
     assert len(decoded) <= len(decoded2), (len(decoded), len(decoded2))
 
-    assert decoded_size > 0, decoded_size
-    if not (flags >> 22) & 0x1:  # do we include the header?
-        print('HEADER')
-        # decomp_size += 22
-        decoded = file_header + decoded
 
-    print(decoded2[len(decoded):])
-    assert len(decoded) == decomp_size, (len(decoded), decomp_size)
+class EntryProbe(NamedTuple):
+    size: int  # bytes stored in sky.dsk
+    unpacked_size: int  # bytes load_file returns
+    rnc: rnccs.RncHeader | None
+    crc_ok: bool | None  # packed CRC, when checked
+    problem: str | None
+
+
+def probe_entry(data_disk_handle, file_info, check_crc=False) -> EntryProbe:
+    # What load_file would do with an entry, from the SKY and RNC headers
+    # alone. Only reads the whole entry to check the packed CRC.
+
+    offset, size, flags = file_info
+
+    data_disk_handle.seek(offset, os.SEEK_SET)
+
+    content = data_disk_handle.read(size if check_crc else min(size, 22 + 0x12))
+
+    if len(content) < min(size, 22 + 0x12):
+        return EntryProbe(size, size, None, None, 'truncated')
+
+    file_header = content[:22]
+
+    uncompressed = (flags >> 23) & 0x1
+
+    if uncompressed or not ((READ_LE_UINT16(file_header) >> 7) & 1):
+        return EntryProbe(size, size, None, None, None)
+
+    decomp_size = (READ_LE_UINT16(file_header) & 0xFF00) << 8
+    decomp_size |= READ_LE_UINT16(file_header[12:14])
+
+    rnc = rnccs.read_header(memoryview(content)[22:])
+    if not rnc:  # load_file returns these as they are
+        return EntryProbe(size, size, None, None, None)
+
+    expected = decomp_size if (flags >> 22) & 0x1 else decomp_size - 22
+    if rnc.unpacked_size != expected:
+        return EntryProbe(size, decomp_size, rnc, None, f'unpacks to {rnc.unpacked_size}, not {expected}')
+    if rnc.packed_size != size - 22 - 0x12:
+        return EntryProbe(size, decomp_size, rnc, None, f'packed size {rnc.packed_size}, not {size - 22 - 0x12}')
+
+    if not check_crc:
+        return EntryProbe(size, decomp_size, rnc, None, None)
+
+    crc_ok = rnccs.check_packed(memoryview(content)[22:], rnc)
+    return EntryProbe(size, decomp_size, rnc, crc_ok, None if crc_ok else 'bad packed CRC')
 
-    return decoded
+
+class BufferStream(io.RawIOBase):
+    # A read-only file object over a buffer. Unlike BytesIO it never copies
+    # the buffer, only the bytes actually read.
+
+    def __init__(self, data):
+        super().__init__()
+        self._view = memoryview(data).cast('B')
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self._view[self._pos:self._pos + len(buffer)]
+        buffer[:len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+    def readall(self):
+        data = bytes(self._view[self._pos:])
+        self._pos = len(self._view)
+        return data
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += len(self._view)
+        if offset < 0:
+            raise ValueError(f'negative seek position {offset}')
+        self._pos = offset
+        return self._pos
+
+    def tell(self):
+        return self._pos
 
 
 def READ_LE_UINT16(data):
@@ -130,60 +228,335 @@ def read_file_entries(stream: IO[bytes]) -> Iterator[tuple[str, DiskFileEntry]]:
         yield str(file_num), read_file_info(stream.read(6))
 
 
+class PatchedEntry(DiskFileEntry):
+    # The index entry of a patched file. It still holds where the file is
+    # on disk, for saving, but reads come from DiskArchive.patches[fname].
+    fname: str = ''
+
+
+class PatchStore(MutableMapping[str, bytes]):
+    # Patched files by name. Once they take more than `memory_limit` bytes,
+    # the earliest ones move to temp files until the rest fit again.
+
+    def __init__(self, memory_limit=64 << 20):
+        self.memory_limit = memory_limit
+        self._items: dict[str, bytes | pathlib.Path] = {}
+        self._memory = 0
+        self._spill_dir: tempfile.TemporaryDirectory | None = None
+
+    def __getitem__(self, fname: str) -> bytes:
+        data = self._items[fname]
+        if isinstance(data, pathlib.Path):
+            return data.read_bytes()
+        return data
+
+    def __setitem__(self, fname: str, data: bytes) -> None:
+        if fname in self._items:
+            del self[fname]
+        data = bytes(data)
+        self._items[fname] = data
+        self._memory += len(data)
+        for name, item in self._items.items():
+            if self._memory <= self.memory_limit:
+                break
+            if not isinstance(item, pathlib.Path):
+                self._items[name] = self._spill(name, item)
+                self._memory -= len(item)
+
+    def __delitem__(self, fname: str) -> None:
+        data = self._items.pop(fname)
+        if isinstance(data, pathlib.Path):
+            data.unlink(missing_ok=True)
+        else:
+            self._memory -= len(data)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._items)
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def _spill(self, fname: str, data: bytes) -> pathlib.Path:
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.TemporaryDirectory(prefix='sky-patches-')
+        path = pathlib.Path(self._spill_dir.name) / fname
+        path.write_bytes(data)
+        return path
+
+
+def split_entry(data, flags) -> tuple[bytes, bytes] | None:
+    # The SKY header and the bytes to RNC-pack so that load_file returns
+    # `data` for an entry with these flags, or None if it has to stay raw.
+    size = len(data)
+    if size > 0xFFFFFF:
+        return None
+
+    if (flags >> 22) & 0x1:  # the header is not part of the file
+        header = bytearray(22)
+        payload = data
+    else:
+        header = bytearray(data[:22])
+        payload = data[22:]
+    if not payload:  # load_file would take an empty unpack for "not packed"
+        return None
+
+    flag = (READ_LE_UINT16(header) & 0x7F) | 0x80 | ((size >> 16) << 8)
+    header[0:2] = flag.to_bytes(2, byteorder='little')
+    header[12:14] = (size & 0xFFFF).to_bytes(2, byteorder='little')
+
+    # load_file hands out the stored header, which has to be the one the
+    # file already starts with.
+    if not (flags >> 22) & 0x1 and header != data[:22]:
+        return None
+
+    return bytes(header), bytes(payload)
+
+
+def write_index(fname, index) -> None:
+    with pathlib.Path(fname).open('wb') as index_file:
+        index_file.write(len(index).to_bytes(4, byteorder='little'))
+        for name, entry in index.items():
+            index_file.write(int(name).to_bytes(2, byteorder='little'))
+            index_file.write(write_file_info(entry))
+
+
+def probe_entries(fname, entries, check_crc=True) -> list[tuple[str, EntryProbe]]:
+    # One worker's share of a scan, on its own handle of the disk file.
+    with pathlib.Path(fname).open('rb') as handle:
+        return [(name, probe_entry(handle, entry, check_crc)) for name, entry in entries]
+
+
+def scan_disk(fname, index, check_crc=True, workers=None, chunksize=64) -> dict[str, EntryProbe]:
+    entries = list(index.items())
+    chunks = [entries[start:start + chunksize] for start in range(0, len(entries), chunksize)]
+    scan = functools.partial(probe_entries, str(fname), check_crc=check_crc)
+    return dict(probe for chunk in rnccs.run_many(scan, chunks, workers) for probe in chunk)
+
+
 class DiskArchive(BaseArchive[DiskFileEntry]):
-    patches: dict[str, bytes] | None = None
+    patches: PatchStore | None = None
+    # Patches beyond this many bytes are kept in temp files.
+    patch_memory: int = 64 << 20
+    verify: float = 0.0
+    # Decoded entries are kept, least recently used first, up to this many
+    # bytes in total. 0 turns the cache off.
+    cache_limit: int = 32 << 20
+    cache_hits: int = 0
+    cache_misses: int = 0
+    _cache: OrderedDict[DiskFileEntry, bytes] | None = None
+    _cache_size: int = 0
+    _index_file: pathlib.Path | None = None
 
     def _create_index(self) -> 'ArchiveIndex[DiskFileEntry]':
         if not self._filename:
             raise ValueError('Must open via filename')
-        dinner = pathlib.Path(self._filename).with_suffix('.dnr')
-        with dinner.open('rb') as dnr_handle:
+        with self.index_file().open('rb') as dnr_handle:
             return dict(read_file_entries(dnr_handle))
 
+    def index_file(self) -> pathlib.Path:
+        # The dinner table this archive reads and save_in_place rewrites, by
+        # default the .dnr next to the disk file.
+        return self._index_file or pathlib.Path(self._filename).with_suffix('.dnr')
+
+    def load_index(self, fname) -> None:
+        # Use another dinner table for the same disk file.
+        if self.patches:
+            raise ValueError('Save or drop the patches before loading another index')
+        self._index_file = pathlib.Path(fname)
+        self.index = self._create_index()
+        self.clear_cache()
+
     @contextmanager
     def _read_entry(self, entry: DiskFileEntry) -> Iterator[IO[bytes]]:
-        yield io.BytesIO(load_file(self._stream, entry))
+        if isinstance(entry, PatchedEntry) and self.patches and entry.fname in self.patches:
+            yield BufferStream(self.patches[entry.fname])
+        else:
+            yield BufferStream(self._load_entry(entry))
+
+    def _load_entry(self, entry: DiskFileEntry) -> bytes:
+        # BufferStream never writes to the buffer, so cached entries can be
+        # handed out as they are.
+        if self._cache is None:
+            self._cache = OrderedDict()
+        data = self._cache.get(entry)
+        if data is not None:
+            self._cache.move_to_end(entry)
+            self.cache_hits += 1
+            return data
+        self.cache_misses += 1
+        data = load_file(self._stream, entry, self.verify)
+        if len(data) <= self.cache_limit:
+            self._cache[entry] = data
+            self._cache_size += len(data)
+            while self._cache_size > self.cache_limit:
+                _, old = self._cache.popitem(last=False)
+                self._cache_size -= len(old)
+        return data
+
+    def _forget(self, entry: DiskFileEntry) -> None:
+        if self._cache and entry in self._cache:
+            self._cache_size -= len(self._cache.pop(entry))
+
+    def clear_cache(self) -> None:
+        self._cache = None
+        self._cache_size = 0
+
+    def scan(self, check_crc=True, workers=None) -> dict[str, EntryProbe]:
+        return scan_disk(self._filename, self.index, check_crc, workers)
 
     def get_file(self, fname: str) -> ArchivePath:
         return ArchivePath(fname, self)
 
     def patch_file(self, fname: str, data: bytes) -> None:
-        if not self.patches:
-            self.patches = {}
+        if self.patches is None:
+            self.patches = PatchStore(self.patch_memory)
         self.patches[fname] = data
-
-    def save_as(self, fname: str, index='sky.dnr') -> None:
+        if fname in self.index:
+            self._forget(self.index[fname])
+            entry = PatchedEntry(*self.index[fname])
+            entry.fname = fname
+            self.index[fname] = entry
+
+    def pack_patches(self, recompress=False, level=rnccs.LAZY, workers=None, cache=None) -> tuple[PatchStore, dict[str, int]]:
+        # The flags to store each patched entry with, and the entries that
+        # are stored RNC packed. Without `recompress` every patch is stored
+        # raw, as it is in `patches`. With it, patches are packed in a worker
+        # pool, a batch of up to `patch_memory` bytes at a time, and kept
+        # packed where that is smaller. Packed entries go to a PatchStore of
+        # their own, so neither side ever holds more than the budget.
+        names = [fname for fname in (self.patches or {}) if fname in self.index]
+        flags = {fname: self.index[fname].flags | (1 << 23) for fname in names}
+        packed = PatchStore(self.patch_memory)
+        if not recompress:
+            return packed, flags
+
+        def pack(batch):
+            payloads = [payload for _, _, payload, _ in batch]
+            for (fname, header, _, size), rnc in zip(batch, rnccs.compress_many(payloads, level, workers, cache=cache)):
+                if len(header) + len(rnc) < size:
+                    packed[fname] = header + rnc
+                    flags[fname] = self.index[fname].flags & ~(1 << 23)
+
+        batch = []
+        batch_size = 0
+        for fname in names:
+            data = self.patches[fname]
+            split = split_entry(data, self.index[fname].flags)
+            if not split:
+                continue
+            batch.append((fname, *split, len(data)))
+            batch_size += len(data)
+            if batch_size >= self.patch_memory:
+                pack(batch)
+                batch = []
+                batch_size = 0
+        if batch:
+            pack(batch)
+        return packed, flags
+
+    def _stored_patch(self, fname: str, packed: PatchStore) -> bytes:
+        return packed[fname] if fname in packed else self.patches[fname]
+
+    def save_as(self, fname: str, index='sky.dnr', recompress=False, level=rnccs.LAZY, workers=None, cache=None, dedupe=True) -> None:
+        # Write the archive, patches included, to a new disk file and index.
+        # The archive itself stays on the file it was opened from, patches
+        # and all; open the new file to read what was saved.
+        if pathlib.Path(fname).resolve() == pathlib.Path(self._filename).resolve():
+            raise ValueError('Use save_in_place to save to the open disk file')
         index_data = dict(self.index.items())
+        new_index = {}
 
         last_offset = 0
-        patches = self.patches or {}
+        packed, patches = self.pack_patches(recompress, level, workers, cache)
         print(patches.keys())
 
+        # With `dedupe`, entries stored as the same bytes are written once
+        # and share an offset. Flags stay per entry.
+        written = {}
+        shared = 0
+        saved = 0
+
         with pathlib.Path(fname).open('wb') as disk_output:
             for fname, (offset, size, flags) in index_data.items():
                 if fname in patches:
-                    self.index[fname] = DiskFileEntry(last_offset, len(patches[fname]), flags | (1 << 23))
-                    disk_output.write(patches[fname])
+                    data, flags = self._stored_patch(fname, packed), patches[fname]
                 else:
-                    self.index[fname] = DiskFileEntry(last_offset, size, flags)
                     self._stream.seek(offset)
-                    disk_output.write(self._stream.read(size))
+                    data = self._stream.read(size)
+                if dedupe:
+                    digest = hashlib.sha256(data).digest()
+                    if digest in written:
+                        new_index[fname] = DiskFileEntry(written[digest], len(data), flags)
+                        shared += 1
+                        saved += len(data)
+                        continue
+                    written[digest] = last_offset
+                new_index[fname] = DiskFileEntry(last_offset, len(data), flags)
+                disk_output.write(data)
                 last_offset = disk_output.tell()
                 if last_offset > 0x7FFFFF:
                     disk_output.write(b'\0' * ((16 - last_offset ) % 16))
                     last_offset = disk_output.tell()
                     assert last_offset & 0xF == 0, last_offset
 
-            with pathlib.Path(index).open('wb') as index_file:
-                index_file.write(len(self.index).to_bytes(4, byteorder='little'))
-                for fname, entry in self.index.items():
-                    index_file.write(int(fname).to_bytes(2, byteorder='little'))
-                    index_file.write(write_file_info(entry))
+            write_index(index, new_index)
+
+        if dedupe:
+            print(f'{shared} duplicate entries share storage, {saved} bytes saved')
+
+    def save_in_place(self, recompress=False, level=rnccs.LAZY, workers=None, cache=None) -> None:
+        # Append the patched entries to the end of the disk file this archive
+        # was opened from and rewrite only its .dnr. The bytes they replace
+        # stay behind as dead space until compact().
+        packed, patches = self.pack_patches(recompress, level, workers, cache)
+        if not patches:
+            return
+        self.clear_cache()
+
+        with pathlib.Path(self._filename).open('r+b') as disk_output:
+            last_offset = disk_output.seek(0, os.SEEK_END)
+            for fname, flags in patches.items():
+                data = self._stored_patch(fname, packed)
+                if last_offset > 0x7FFFFF:
+                    disk_output.write(b'\0' * ((16 - last_offset) % 16))
+                    last_offset = disk_output.tell()
+                    assert last_offset & 0xF == 0, last_offset
+                self.index[fname] = DiskFileEntry(last_offset, len(data), flags)
+                disk_output.write(data)
+                last_offset = disk_output.tell()
+            # The new .dnr must not point at bytes that are not on disk yet.
+            disk_output.flush()
+            os.fsync(disk_output.fileno())
+
+        dinner = self.index_file()
+        temp = dinner.with_name(dinner.name + '.tmp')
+        write_index(temp, self.index)
+        os.replace(temp, dinner)
+        self.patches = None
+
+    def dead_bytes(self) -> int:
+        # Bytes of the disk file no entry points at, padding included.
+        live = {(entry.offset, entry.size) for entry in self.index.values()}
+        return os.path.getsize(self._filename) - sum(size for _, size in live)
 
 
 
 open = make_opener(DiskArchive)
 
+
+def compact(fname, index=None) -> None:
+    # Rewrite a disk file with just the entries its .dnr (or `index`) points
+    # at, dropping the dead space save_in_place leaves behind.
+    fname = pathlib.Path(fname)
+    index = pathlib.Path(index) if index else fname.with_suffix('.dnr')
+    temp_disk = fname.with_name(fname.name + '.tmp')
+    temp_index = index.with_name(index.name + '.tmp')
+    with open(fname) as arc:
+        arc.load_index(index)
+        arc.save_as(temp_disk, temp_index)
+    os.replace(temp_disk, fname)
+    os.replace(temp_index, index)
+
 if __name__ == '__main__':
     from rnccs import RNCCompressor, decompress
 
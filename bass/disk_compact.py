@@ -0,0 +1,21 @@
+import disk
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Reclaim the space save_in_place leaves in sky.dsk')
+    parser.add_argument('fname', nargs='?', default='sky.dsk')
+    parser.add_argument('--index', help='Dinner table, by default next to the disk file')
+    args = parser.parse_args()
+
+    def dead_bytes():
+        with disk.open(args.fname) as dsk:
+            if args.index:
+                dsk.load_index(args.index)
+            return dsk.dead_bytes()
+
+    before = dead_bytes()
+    disk.compact(args.fname, args.index)
+    after = dead_bytes()
+    print(f'{before - after} bytes reclaimed, {after} bytes of padding left')
@@ -0,0 +1,213 @@
+import hashlib
+import os
+import pathlib
+import struct
+import zlib
+from typing import IO, NamedTuple
+
+import disk
+
+
+# A patch rebuilds a modified sky.dsk byte for byte from the original one.
+# It starts with a header and the whole new dinner table, which is small,
+# followed by the operations that write the new .dsk from start to end:
+#   COPY length offset   bytes from the original .dsk
+#   DATA length bytes    bytes stored in the patch
+#   ZERO length          zero bytes, such as alignment padding
+# Every number is little-endian, like the dinner table itself.
+MAGIC = b'SKYDELTA'
+HEADER = struct.Struct('<8sIIIII')  # magic, source size, target size and CRC-32, .dnr size and CRC-32
+OPERATION = struct.Struct('<BI')
+END, COPY, DATA, ZERO = range(4)
+
+# The applier never holds more than this much of an entry in memory.
+CHUNK_SIZE = 1 << 20
+
+
+class PatchStats(NamedTuple):
+    entries: int
+    changed: int  # entries whose bytes are not in the original .dsk
+    copied: int  # bytes taken from the original .dsk
+    stored: int  # bytes carried in the patch
+
+
+class PatchWriter:
+    # Writes the operations, merging copies of consecutive source bytes.
+
+    def __init__(self, stream: IO[bytes]):
+        self.stream = stream
+        self.copy: tuple[int, int] | None = None
+        self.copied = 0
+        self.stored = 0
+
+    @property
+    def copy_end(self) -> int | None:
+        return self.copy[0] + self.copy[1] if self.copy else None
+
+    def copy_from(self, offset: int, length: int) -> None:
+        self.copied += length
+        if self.copy_end == offset:
+            self.copy = (self.copy[0], self.copy[1] + length)
+            return
+        self.flush()
+        self.copy = (offset, length)
+
+    def data(self, data: bytes) -> None:
+        self.flush()
+        if not any(data):
+            self.stream.write(OPERATION.pack(ZERO, len(data)))
+            return
+        self.stored += len(data)
+        self.stream.write(OPERATION.pack(DATA, len(data)))
+        self.stream.write(data)
+
+    def flush(self) -> None:
+        if self.copy:
+            offset, length = self.copy
+            self.stream.write(OPERATION.pack(COPY, length))
+            self.stream.write(offset.to_bytes(4, byteorder='little'))
+            self.copy = None
+
+    def end(self) -> None:
+        self.flush()
+        self.stream.write(OPERATION.pack(END, 0))
+
+
+def read_at(stream: IO[bytes], offset: int, size: int) -> bytes:
+    stream.seek(offset)
+    return stream.read(size)
+
+
+def file_crc(fname) -> int:
+    crc = 0
+    with pathlib.Path(fname).open('rb') as stream:
+        while chunk := stream.read(CHUNK_SIZE):
+            crc = zlib.crc32(chunk, crc)
+    return crc
+
+
+def make_patch(original: disk.DiskArchive, modified: disk.DiskArchive, fname) -> PatchStats:
+    # Entries are matched by the SHA-256 of their stored bytes rather than by
+    # name or offset, so moved, renamed and duplicated entries are copied.
+    if modified.patches:
+        raise ValueError('Save the modified archive before making a patch')
+
+    source = original._stream
+    target = modified._stream
+    source_size = os.path.getsize(original._filename)
+    target_size = os.path.getsize(modified._filename)
+    dinner = modified.index_file().read_bytes()
+
+    known = {}
+    for offset, size, _ in set(original.index.values()):
+        known.setdefault(hashlib.sha256(read_at(source, offset, size)).digest(), offset)
+
+    new_extents = set()
+    with pathlib.Path(fname).open('wb') as output:
+        output.write(HEADER.pack(MAGIC, source_size, target_size, file_crc(modified._filename), len(dinner), zlib.crc32(dinner)))
+        output.write(dinner)
+        writer = PatchWriter(output)
+
+        pos = 0
+        for offset, size in sorted({(entry.offset, entry.size) for entry in modified.index.values()}):
+            if offset + size <= pos:  # shares bytes already written
+                continue
+            if offset > pos:
+                gap = read_at(target, pos, offset - pos)
+                if writer.copy_end is not None and read_at(source, writer.copy_end, len(gap)) == gap:
+                    writer.copy_from(writer.copy_end, len(gap))
+                else:
+                    writer.data(gap)
+                pos = offset
+            data = read_at(target, offset, size)
+            source_offset = known.get(hashlib.sha256(data).digest())
+            if source_offset is not None:
+                writer.copy_from(source_offset + pos - offset, offset + size - pos)
+            else:
+                writer.data(data[pos - offset:])
+                new_extents.add((offset, size))
+            pos = offset + size
+        if pos < target_size:
+            writer.data(read_at(target, pos, target_size - pos))
+        writer.end()
+
+    changed = sum(1 for entry in modified.index.values() if (entry.offset, entry.size) in new_extents)
+    return PatchStats(len(modified.index), changed, writer.copied, writer.stored)
+
+
+def apply_patch(fname, source_name, target_name, index_name=None) -> None:
+    # One pass over the patch, writing the new .dsk in order. Both outputs go
+    # to temp files that only replace the targets once their CRCs match, so
+    # the source may also be the target.
+    target_name = pathlib.Path(target_name)
+    index_name = pathlib.Path(index_name) if index_name else target_name.with_suffix('.dnr')
+    temp_disk = target_name.with_name(target_name.name + '.tmp')
+    temp_index = index_name.with_name(index_name.name + '.tmp')
+
+    try:
+        with pathlib.Path(fname).open('rb') as patch, pathlib.Path(source_name).open('rb') as source:
+            magic, source_size, target_size, target_crc, dinner_size, dinner_crc = HEADER.unpack(patch.read(HEADER.size))
+            if magic != MAGIC:
+                raise Exception("Bad sky.dsk patch")
+            if os.path.getsize(source_name) != source_size:
+                raise Exception("Patch is for a different sky.dsk")
+
+            dinner = patch.read(dinner_size)
+            if zlib.crc32(dinner) != dinner_crc:
+                raise Exception("Bad CRC at patched sky.dnr")
+            temp_index.write_bytes(dinner)
+
+            crc = 0
+            with temp_disk.open('wb') as output:
+                while True:
+                    operation, length = OPERATION.unpack(patch.read(OPERATION.size))
+                    if operation == END:
+                        break
+                    if operation == COPY:
+                        source.seek(int.from_bytes(patch.read(4), byteorder='little'))
+                    elif operation not in (DATA, ZERO):
+                        raise Exception(f"Bad patch operation {operation}")
+                    while length > 0:
+                        size = min(length, CHUNK_SIZE)
+                        if operation == ZERO:
+                            chunk = bytes(size)
+                        else:
+                            chunk = (source if operation == COPY else patch).read(size)
+                            if len(chunk) != size:
+                                raise Exception("Patch or sky.dsk is cut short")
+                        crc = zlib.crc32(chunk, crc)
+                        output.write(chunk)
+                        length -= size
+                size = output.tell()
+
+        if size != target_size or crc != target_crc:
+            raise Exception("Bad CRC at patched sky.dsk")
+        os.replace(temp_disk, target_name)
+        os.replace(temp_index, index_name)
+    finally:
+        temp_disk.unlink(missing_ok=True)
+        temp_index.unlink(missing_ok=True)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Make or apply sky.dsk delta patches')
+    commands = parser.add_subparsers(dest='command', required=True)
+    make = commands.add_parser('make', help='Patch that turns ORIGINAL into MODIFIED')
+    make.add_argument('original')
+    make.add_argument('modified')
+    make.add_argument('patch')
+    apply = commands.add_parser('apply', help='Rebuild the modified disk from SOURCE')
+    apply.add_argument('patch')
+    apply.add_argument('source', nargs='?', default='sky.dsk')
+    apply.add_argument('target', nargs='?', help='Defaults to overwriting SOURCE and its .dnr')
+    args = parser.parse_args()
+
+    if args.command == 'make':
+        with disk.open(args.original) as original, disk.open(args.modified) as modified:
+            stats = make_patch(original, modified, args.patch)
+        print(f'{stats.changed} of {stats.entries} entries changed, {stats.stored} bytes stored, {stats.copied} copied')
+        print(f'{args.patch}: {os.path.getsize(args.patch)} bytes')
+    else:
+        apply_patch(args.patch, args.source, args.target or args.source)
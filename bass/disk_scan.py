@@ -0,0 +1,35 @@
+import time
+
+import disk
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Check every entry of sky.dsk from its headers, without unpacking')
+    parser.add_argument('fname', nargs='?', default='sky.dsk')
+    parser.add_argument('--no-crc', action='store_true', help='Only parse headers, skip the packed CRC')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--verbose', '-v', action='store_true', help='List every entry')
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    with disk.open(args.fname) as dsk:
+        results = dsk.scan(check_crc=not args.no_crc, workers=args.workers)
+    elapsed = time.perf_counter() - start
+
+    stored = sum(probe.size for probe in results.values())
+    unpacked = sum(probe.unpacked_size for probe in results.values())
+    packed = sum(1 for probe in results.values() if probe.rnc)
+    corrupt = {fname: probe for fname, probe in results.items() if probe.problem}
+
+    if args.verbose:
+        for fname, probe in results.items():
+            kind = 'rnc' if probe.rnc else 'raw'
+            print(f'{fname:>6} {kind} {probe.size:8} -> {probe.unpacked_size:8} {probe.problem or ""}')
+
+    print(f'{len(results)} entries, {packed} packed, {stored} bytes stored, {unpacked} unpacked ({elapsed:.2f}s)')
+    for fname, probe in corrupt.items():
+        print(f'{fname}: {probe.problem}')
+    if corrupt:
+        raise SystemExit(f'{len(corrupt)} corrupt entries')
@@ -1,4 +1,5 @@
 import disk
+from rnc_cache import CompressionCache
 
 
 import numpy as np
@@ -151,6 +152,6 @@ if __name__ == '__main__':
             im.save(f'{font["name"]}_test.png')
             dsk.patch_file(str(font['file']), font_data)
 
-        dsk.save_as('sky.dsk')
+        dsk.save_as('sky.dsk', recompress=True, cache=CompressionCache())
             # for i, char in enumerate(generate_game_characters(font_data, font['spacing'], font['height']), start=0x20):
             #     print(bytes([i]).decode('cp862', errors='ignore'), char.shape)
@@ -0,0 +1,217 @@
+import pathlib
+import random
+import time
+
+import rnccs
+from rnc_crc import crc16, crctable
+from rnccs import BitReader, RNCCompressor
+
+
+def sample_data(size, seed=0):
+    # Something shaped like sky.dsk resources: runs of one colour, rows
+    # repeated with small changes and short stretches of noise.
+    rng = random.Random(seed)
+    palette = bytes(rng.randrange(256) for _ in range(24))
+    out = bytearray()
+    while len(out) < size:
+        kind = rng.random()
+        if kind < 0.3:
+            out += bytes([rng.choice(palette)]) * rng.randrange(1, 48)
+        elif kind < 0.6 and len(out) > 320:
+            start = len(out) - rng.choice((320, 160, 64, rng.randrange(1, 320)))
+            row = bytearray(out[start:start + rng.randrange(4, 64)])
+            for _ in range(rng.randrange(3)):
+                row[rng.randrange(len(row))] = rng.choice(palette)
+            out += row
+        else:
+            out += bytes(rng.choice(palette) for _ in range(rng.randrange(1, 16)))
+    return bytes(out[:size])
+
+
+class NaiveCompressor(RNCCompressor):
+    # The original full-window scan, kept as the reference for benchmarks.
+
+    def find_sequence(self, pos, length, maxpos):
+        if pos == 0:
+            return length, 0
+        num = pos - 0x7fff
+        if num < 0:
+            num = 0
+        num2 = 2
+        num3 = 0
+        num4 = 1
+        num5 = 0
+        while pos - num4 >= num and num2 < 0x1000:
+            num5 = 0
+            index = pos
+            num7 = index - num4
+            while index < maxpos and self.ibuf[index] == self.ibuf[num7] and num5 < 0x1000:
+                index += 1
+                num7 += 1
+                num5 += 1
+            if num5 > num2:
+                num2 = num5
+                num3 = num4
+            num4 += 1
+        return num2, num3
+
+
+class WordBitReader:
+    # The reading half of rnccs.BitBuffer before BitReader, refilling 16 bits
+    # at a time.
+
+    def __init__(self, data, pos=0):
+        self.bitbuf = 0
+        self.bitpos = 0
+        self.buf = data
+        self.pos = pos
+
+    def clear_buf(self, bits):
+        self.bitbuf = self.bitbuf >> bits
+        self.bitpos -= bits
+
+    def get_bytes(self, length):
+        destination_array = bytearray(length)
+        if self.bitpos >= 0x10:
+            self.bitpos -= 0x10
+            self.bitbuf &= ((1 << self.bitpos) - 1)
+            self.pos -= 2
+        destination_array[:length] = self.buf[self.pos:self.pos+length]
+        self.pos += length
+        return destination_array
+
+    def normalize_buf(self, bits):
+        while bits > self.bitpos:
+            num = 0
+            if (self.pos + 1) == len(self.buf):
+                num = self.buf[-1]
+            elif self.pos < len(self.buf):
+                num = int.from_bytes(self.buf[self.pos:self.pos+2], 'little')
+            self.pos += 2
+            self.bitbuf |= (num << self.bitpos)
+            self.bitpos += 0x10
+
+    def peek_bits(self, bits):
+        self.normalize_buf(bits)
+        return (self.bitbuf & ((1 << bits) - 1))
+
+    def read_bits(self, bits):
+        num = self.peek_bits(bits)
+        self.clear_buf(bits)
+        return num
+
+
+def rnccs_crc16(data):
+    # rnccs.calc_crc16 before the shared module.
+    crc = 0
+    for byte in data:
+        crc = (crc >> 8) ^ crctable[(crc ^ byte) & 0xFF]
+    return crc
+
+
+def rnc_deco_crc16(data):
+    # RncDecoder.crcBlock before the shared module.
+    table = bytearray(0x200)
+    for i, value in enumerate(crctable):
+        table[2*i:2*i + 2] = value.to_bytes(2, 'little')
+    crc = 0
+    for i in range(len(data)):
+        tmp = data[i]
+        crc ^= tmp
+        tmp = (crc >> 8) & 0x00FF
+        crc &= 0x00FF
+        crc = int.from_bytes(table[crc << 1:][:2], 'little')
+        crc ^= tmp
+    return crc
+
+
+def timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def bench_match_finder(data):
+    block = data[:0x3000]
+    print(f'match finder, one 0x{len(block):x}-byte block')
+    naive_time, naive = timed(NaiveCompressor.compress, block)
+    print(f'  full window scan: {naive_time:8.3f}s -> {len(naive)} bytes')
+    chain_time, chained = timed(RNCCompressor.compress, block)
+    print(f'  hash chains:      {chain_time:8.3f}s -> {len(chained)} bytes ({naive_time / chain_time:.0f}x)')
+    assert chained == naive
+    assert rnccs.decompress(chained) == block
+
+
+def bench_crc(data, size=4 << 20):
+    data = (data * (size // len(data) + 1))[:size]
+    print(f'crc16, {size / (1 << 20):.0f} MB')
+    results = []
+    for name, func in (('rnccs loop', rnccs_crc16), ('rnc_deco loop', rnc_deco_crc16), ('rnc_crc', crc16)):
+        elapsed, crc = timed(func, data)
+        print(f'  {name + ":":17} {elapsed:8.3f}s ({size / elapsed / (1 << 20):7.1f} MB/s)')
+        results.append(crc)
+    assert len(set(results)) == 1, results
+
+
+def bench_levels(data, size=0x10000):
+    data = data[:size]
+    print(f'compression levels, {len(data)} bytes')
+    print(f'  {"level":8} {"packed":>8} {"ratio":>6} {"KB/s":>8}')
+    for name, level in (('greedy', rnccs.GREEDY), ('lazy', rnccs.LAZY), ('optimal', rnccs.OPTIMAL)):
+        elapsed, packed = timed(RNCCompressor.compress, data, level)
+        assert rnccs.decompress(packed) == data
+        print(f'  {name:8} {len(packed):8} {len(packed) / len(data):6.3f} {len(data) / elapsed / 1024:8.1f}')
+
+
+def bench_methods(data, size=0x10000):
+    data = data[:size]
+    print(f'RNC methods, {len(data)} bytes')
+    print(f'  {"method":8} {"packed":>8} {"ratio":>6} {"unpack KB/s":>12}')
+    for method in (1, 2):
+        packed = rnccs.compress(data, method=method)
+        elapsed, unpacked = timed(rnccs.decompress, packed)
+        assert unpacked == data
+        print(f'  {method:<8} {len(packed):8} {len(packed) / len(data):6.3f} {len(data) / elapsed / 1024:12.1f}')
+
+
+def read_stream(reader, widths):
+    # Roughly what decoding does: bit fields of mixed widths, with a short
+    # run of literal bytes every few fields.
+    values = []
+    for num, bits in enumerate(widths):
+        values.append(reader.read_bits(bits))
+        if num % 8 == 7:
+            values.extend(reader.get_bytes(bits))
+    return values
+
+
+def bench_bit_reader(data, fields=200000):
+    rng = random.Random(1)
+    widths = [rng.choice((1, 2, 3, 4, 5, 7, 9, 12, 16)) for _ in range(fields)]
+    data = data * (fields * 4 // len(data) + 1)
+    print(f'bit reader, {fields} fields')
+    results = []
+    for name, cls in (('16-bit refill', WordBitReader), ('BitReader', BitReader)):
+        elapsed, values = timed(read_stream, cls(data), widths)
+        print(f'  {name + ":":17} {elapsed:8.3f}s')
+        results.append(values)
+    assert results[0] == results[1]
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('fname', nargs='?', help='Benchmark on this file instead of generated data')
+    args = parser.parse_args()
+
+    if args.fname:
+        data = pathlib.Path(args.fname).read_bytes()
+    else:
+        data = sample_data(0x40000)
+
+    bench_match_finder(data)
+    bench_crc(data)
+    bench_bit_reader(data)
+    bench_levels(data)
+    bench_methods(data)
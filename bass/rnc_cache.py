@@ -0,0 +1,98 @@
+import hashlib
+import os
+import pathlib
+import tempfile
+
+import rnccs
+
+
+# Bump when a compressor change makes it write different output for the
+# same input, so older results stop matching.
+VERSION = 1
+
+
+class CompressionCache:
+    # Packed results on disk, one file per input, named by a hash of the
+    # input bytes and the compressor parameters. Reading a result touches
+    # its mtime, and evict() drops the least recently used files once the
+    # directory holds more than `max_bytes`.
+
+    def __init__(self, path='.rnc_cache', max_bytes=256 << 20):
+        self.path = pathlib.Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, data, level=rnccs.LAZY, method=1):
+        digest = hashlib.sha256(data).hexdigest()
+        return f'{digest}-m{method}-l{level}-v{VERSION}'
+
+    def get(self, key):
+        fname = self.path / key
+        try:
+            packed = fname.read_bytes()
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        # A file cut short by a crash or a full disk is a miss, not an error.
+        header = rnccs.read_header(packed)
+        if not header or not rnccs.check_packed(packed, header):
+            fname.unlink(missing_ok=True)
+            self.misses += 1
+            return None
+        os.utime(fname)
+        self.hits += 1
+        return packed
+
+    def put(self, key, packed):
+        # Write then rename, so other processes never see half a file.
+        handle, temp = tempfile.mkstemp(dir=self.path, prefix='.tmp-')
+        with os.fdopen(handle, 'wb') as temp_file:
+            temp_file.write(packed)
+        os.replace(temp, self.path / key)
+
+    def evict(self):
+        entries = []
+        for fname in self.path.iterdir():
+            if fname.name.startswith('.tmp-'):
+                continue
+            try:
+                stat = fname.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, fname))
+        total = sum(size for _, size, _ in entries)
+        for _, size, fname in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            fname.unlink(missing_ok=True)
+            total -= size
+
+    def compress_many(self, payloads, level=rnccs.LAZY, workers=None, chunksize=1, method=1):
+        # Like rnccs.compress_many, but only inputs that are not cached yet
+        # go to the workers.
+        payloads = list(payloads)
+        keys = [self.key(data, level, method) for data in payloads]
+        results = [self.get(key) for key in keys]
+        missing = [num for num, packed in enumerate(results) if packed is None]
+        packed = rnccs.compress_many([payloads[num] for num in missing], level, workers, chunksize, method)
+        for num, data in zip(missing, packed):
+            results[num] = data
+            self.put(keys[num], data)
+        if missing:
+            self.evict()
+        return results
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Trim or clear the RNC compression cache')
+    parser.add_argument('path', nargs='?', default='.rnc_cache')
+    parser.add_argument('--max-mb', type=float, default=256)
+    parser.add_argument('--clear', action='store_true')
+    args = parser.parse_args()
+
+    cache = CompressionCache(args.path, 0 if args.clear else int(args.max_mb * (1 << 20)))
+    cache.evict()
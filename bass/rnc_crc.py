@@ -0,0 +1,66 @@
+import functools
+
+import numpy as np
+
+
+# CRC-16/ARC, as used by both RNC ProPack methods.
+
+def gen_crc(crc):
+    for _ in range(8):
+        if crc & 1:
+            crc = (crc >> 1) ^ 0xA001
+        else:
+            crc >>= 1
+    assert crc & 0xFFFF == crc, crc
+    return crc
+
+crctable = [gen_crc(i) for i in range(0x100)]
+np_crctable = np.array(crctable, dtype=np.uint16)
+
+# Below this size the plain table loop is faster than setting up lanes.
+LANES_MIN_SIZE = 0x4000
+
+
+def crc16_loop(data, crc=0):
+    for byte in data:
+        crc = (crc >> 8) ^ crctable[(crc ^ byte) & 0xFF]
+    return crc
+
+
+@functools.cache
+def shift_tables(length):
+    # The CRC is linear, so running a register through `length` zero bytes
+    # is a fixed 16x16 bit matrix. Split it into one table per register byte.
+    columns = [crc16_loop(bytes(length), 1 << bit) for bit in range(16)]
+    low = [0] * 0x100
+    high = [0] * 0x100
+    for value in range(1, 0x100):
+        bit = value.bit_length() - 1
+        rest = value ^ (1 << bit)
+        low[value] = low[rest] ^ columns[bit]
+        high[value] = high[rest] ^ columns[bit + 8]
+    return low, high
+
+
+def crc16(data, crc=0):
+    data = memoryview(data).cast('B')
+    size = len(data)
+    if size < LANES_MIN_SIZE:
+        return crc16_loop(data, crc)
+
+    # Cut the input into equal lanes and run all of them at once, one byte
+    # column per step, each lane starting from zero. Then fold the lanes in
+    # order: crc(c, A + B) == shift(crc(c, A), len(B)) ^ crc(0, B).
+    length = 1 << ((size.bit_length() - 4) // 2)
+    lanes = size // length
+    head = size - lanes * length
+    crc = crc16_loop(data[:head], crc)
+    columns = np.frombuffer(data[head:], dtype=np.uint8).reshape(lanes, length).T.copy()
+    regs = np.zeros(lanes, dtype=np.uint16)
+    for column in columns:
+        regs = (regs >> 8) ^ np_crctable[(regs ^ column) & 0xFF]
+
+    low, high = shift_tables(length)
+    for reg in regs.tolist():
+        crc = low[crc & 0xFF] ^ high[crc >> 8] ^ reg
+    return crc
@@ -1,5 +1,7 @@
 # Implementation based on: https://github.com/scummvm/scummvm/blob/9e7849a30ce1f26e7a70f176b89a8415bd687d14/common/compression/rnc_deco.cpp
 
+from rnc_crc import crc16
+
 NOT_PACKED = 0
 PACKED_CRC =-1
 UNPACKED_CRC = -2
@@ -28,41 +30,12 @@ class RncDecoder:
         self._dstPtr = None
         self._inputByteLeft = 0
 
-        self._crcTable = bytearray(0x200)
         self._rawTable = [0] * 64
         self._posTable = [0] * 64
         self._lenTable = [0] * 64
 
-        self.initCrc()
-
-    def initCrc(self):
-        tmp1 = 0
-        tmp2 = 0
-
-        for tmp2 in range(256):
-            tmp1 = tmp2
-            for cnt in range(8, 0, -1):
-                if tmp1 % 2:
-                    tmp1 >>= 1
-                    tmp1 ^= 0x0a001
-                else:
-                    tmp1 >>= 1
-            self._crcTable[2*tmp2:2*tmp2 + 2] = tmp1.to_bytes(2, byteorder='little', signed=False)
-
     def crcBlock(self, block, size):
-        crc = 0
-        crcTable8 = self._crcTable
-        tmp = 0
-
-        for i in range(size):
-            tmp = block[i]
-            crc ^= tmp
-            tmp = (crc >> 8) & 0x00FF
-            crc &= 0x00FF
-            crc = READ_LE_UINT16(crcTable8[crc << 1:])
-            crc ^= tmp
-
-        return crc
+        return crc16(memoryview(block)[:size])
 
     def inputBits(self, amount):
         newBitBuffh = self._bitBuffh
@@ -207,8 +180,7 @@ class RncDecoder:
         inputptr += 2
         inputptr = inputptr + HEADER_LEN - 16
 
-        print(crcPacked, crcUnpacked)
-        if self.crcBlock(input[inputptr:], packLen) != crcPacked:
+        if self.crcBlock(memoryview(input)[inputptr:], packLen) != crcPacked:
             return PACKED_CRC
 
         inputptr = HEADER_LEN
@@ -218,7 +190,9 @@ class RncDecoder:
         outputLow = 0
         outputHigh = input[16] + unpackLen + outputLow
 
-        if not (inputHigh <= outputLow or outputHigh <= inputHigh):
+        # The offsets only compare when the packed data sits in the output
+        # buffer itself, to be unpacked in place.
+        if input is output and not (inputHigh <= outputLow or outputHigh <= inputHigh):
             self._srcPtr = inputHigh
             self._dstPtr = outputHigh
             output[self._dstPtr-packLen:self._dstPtr] = input[self._srcPtr-packLen:self._srcPtr]
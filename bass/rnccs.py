@@ -1,44 +1,67 @@
-class BitBuffer:
+from array import array
+import concurrent.futures
+import functools
+import heapq
+from typing import Iterator, NamedTuple
+
+import numpy as np
+
+from rnc_crc import crc16
+
+
+class BitReader:
+    # RNC method 1 packs bits into little-endian 16-bit words, lowest bit
+    # first, and stores literal bytes between those words. Refill 64 bits at
+    # a time; whole words that were fetched early go back on get_bytes.
+
     def __init__(self, data, pos=0):
-        self.advsize = 2
+        self.buf = memoryview(data).cast('B')
         self.bitbuf = 0
         self.bitpos = 0
-        self.buf = data
         self.pos = pos
 
-    def clear_buf(self, bits):
-        self.bitbuf = self.bitbuf >> bits
+    def peek_bits(self, bits):
+        if bits > self.bitpos:
+            # Past the end of the data this reads zeros, like the game does.
+            self.bitbuf |= int.from_bytes(self.buf[self.pos:self.pos+8], 'little') << self.bitpos
+            self.pos += 8
+            self.bitpos += 64
+        return self.bitbuf & ((1 << bits) - 1)
+
+    def skip_bits(self, bits):
+        self.bitbuf >>= bits
         self.bitpos -= bits
 
+    def read_bits(self, bits):
+        num = self.peek_bits(bits)
+        self.bitbuf >>= bits
+        self.bitpos -= bits
+        return num
+
     def get_bytes(self, length):
-        destination_array = bytearray(length)
-        if self.bitpos >= 0x10:
-            self.bitpos -= 0x10
-            self.bitbuf &= ((1 << self.bitpos) - 1)
-            self.pos -= 2
-        destination_array[:length] = self.buf[self.pos:self.pos+length]
+        words = self.bitpos >> 4
+        if words:
+            self.pos -= 2 * words
+            self.bitpos &= 0xF
+            self.bitbuf &= (1 << self.bitpos) - 1
+        data = self.buf[self.pos:self.pos+length]
         self.pos += length
-        return destination_array
-
-    def normalize_buf(self, bits):
-        while bits > self.bitpos:
-            num = 0
-            if (self.pos + 1) == len(self.buf):
-                num = self.buf[-1]
-            elif self.pos < len(self.buf):
-                num = int.from_bytes(self.buf[self.pos:self.pos+2], 'little')
-            self.pos += 2
-            self.bitbuf |= (num << self.bitpos)
-            self.bitpos += 0x10
+        return data
 
-    def peek_bits(self, bits):
-        self.normalize_buf(bits)
-        return (self.bitbuf & ((1 << bits) - 1))
 
-    def read_bits(self, bits):
-        num = self.peek_bits(bits)
-        self.clear_buf(bits)
-        return num
+class BitBuffer:
+    def __init__(self, data, pos=0):
+        self.advsize = 2
+        self.bitbuf = 0
+        self.bitpos = 0
+        self.buf = data
+        self.pos = pos
+
+    def reserve(self, end):
+        # Slice assignment past the end of a bytearray appends at the end
+        # instead of at `pos`, so grow the buffer before writing there.
+        if end > len(self.buf):
+            self.buf.extend(bytes(max(end - len(self.buf), len(self.buf))))
 
     def write_bits(self, value, bits):
         self.bitbuf |= ((value & ((1 << (bits & 0x1f)) - 1)) << (self.bitpos & 0x1f))
@@ -47,15 +70,18 @@ class BitBuffer:
             num = self.bitbuf & 0xffff
             self.bitpos -= 0x10
             self.bitbuf = self.bitbuf >> 0x10
+            self.reserve(self.pos + 2)
             self.buf[self.pos:self.pos+2] = num.to_bytes(2, 'little')
             self.pos += self.advsize
             self.advsize = 2
 
     def write_bytes(self, data):
         if self.bitpos == 0:
+            self.reserve(self.pos + len(data))
             self.buf[self.pos:self.pos+len(data)] = data
             self.pos += len(data)
         else:
+            self.reserve(self.pos + self.advsize + len(data))
             self.buf[self.pos + self.advsize:self.pos + self.advsize + len(data)] = data
             self.advsize += len(data)
 
@@ -67,22 +93,79 @@ class BitBuffer:
     def position(self):
         return self.pos
 
-def gen_crc(crc):
-    for _ in range(8):
-        if crc & 1:
-            crc = (crc >> 1) ^ 0xA001
-        else:
-            crc >>= 1
-    assert crc & 0xFFFF == crc, crc
-    return crc
 
-crctable = [gen_crc(i) for i in range(0x100)]
+class BitReaderM2:
+    # RNC method 2 reads bits highest first from single bytes, and fetches
+    # the next byte of bits only when it runs out, from wherever the stream
+    # has got to by then. Literal bytes follow whichever byte of bits was
+    # being read when they were written.
+
+    def __init__(self, data, pos=0):
+        self.buf = memoryview(data).cast('B')
+        self.bitbuf = 0
+        self.bitpos = 0
+        self.pos = pos
+
+    def read_bit(self):
+        if not self.bitpos:
+            # Past the end of the data this reads zeros, like BitReader.
+            self.bitbuf = self.buf[self.pos] if self.pos < len(self.buf) else 0
+            self.pos += 1
+            self.bitpos = 8
+        self.bitpos -= 1
+        return (self.bitbuf >> self.bitpos) & 1
+
+    def read_bits(self, bits):
+        num = 0
+        for _ in range(bits):
+            num = (num << 1) | self.read_bit()
+        return num
+
+    def get_bytes(self, length):
+        data = self.buf[self.pos:self.pos+length]
+        self.pos += length
+        return data
+
+
+class BitBufferM2:
+    # The writing side of BitReaderM2: a byte for bits is set aside in the
+    # output when the first of its bits is written, and filled in as more
+    # bits follow the literals written after it.
+
+    def __init__(self, data, pos=0):
+        self.bitbyte = 0
+        self.bitpos = 0
+        self.buf = data
+        self.pos = pos
+
+    reserve = BitBuffer.reserve
+
+    def write_bits(self, value, bits):
+        while bits:
+            if not self.bitpos:
+                self.reserve(self.pos + 1)
+                self.bitbyte = self.pos
+                self.buf[self.pos] = 0
+                self.pos += 1
+                self.bitpos = 8
+            num = min(bits, self.bitpos)
+            bits -= num
+            self.bitpos -= num
+            self.buf[self.bitbyte] |= ((value >> bits) & ((1 << num) - 1)) << self.bitpos
+
+    def write_bytes(self, data):
+        self.reserve(self.pos + len(data))
+        self.buf[self.pos:self.pos+len(data)] = data
+        self.pos += len(data)
+
+    def write_end(self):
+        # Unused bits of the last byte are already zero.
+        pass
+
+    @property
+    def position(self):
+        return self.pos
 
-def calc_crc16(data):
-    crc = 0
-    for byte in data:
-        crc = (crc >> 8) ^ crctable[(crc ^ byte) & 0xFF]
-    return crc
 
 class Huff:
     def __init__(self, ln, code, value):
@@ -91,12 +174,63 @@ class Huff:
         self.value = value
 
 
+# Code lengths are stored in 4-bit fields, so no code may be longer.
+MAX_CODE_LENGTH = 15
+
+
+def huff_lengths(freq, limit=MAX_CODE_LENGTH):
+    # Code length for each symbol, 0 for symbols that never occur.
+    lengths = [0] * len(freq)
+    used = sorted((count, value) for value, count in enumerate(freq) if count > 0)
+    if len(used) == 1:
+        lengths[used[0][1]] = 1
+    if len(used) < 2:
+        return lengths
+
+    heap = [(count, value, [value]) for count, value in used]
+    while len(heap) > 1:
+        count1, key, values1 = heapq.heappop(heap)
+        count2, _, values2 = heapq.heappop(heap)
+        for value in values1 + values2:
+            lengths[value] += 1
+        heapq.heappush(heap, (count1 + count2, key, values1 + values2))
+    if max(lengths) <= limit:
+        return lengths
+
+    # Package-merge: the 2n-2 cheapest items across `limit` levels of
+    # paired packages give each symbol its depth in the best limited code.
+    leaves = [(count, (value,)) for count, value in used]
+    packages = leaves
+    for _ in range(limit - 1):
+        pairs = [(a[0] + b[0], a[1] + b[1]) for a, b in zip(packages[::2], packages[1::2])]
+        packages = list(heapq.merge(leaves, pairs, key=lambda item: item[0]))
+    lengths = [0] * len(freq)
+    for _, values in packages[:2 * len(leaves) - 2]:
+        for value in values:
+            lengths[value] += 1
+    return lengths
+
+
+def canonical_codes(lengths):
+    # RNC hands out codes shortest first, then by symbol, and stores each one
+    # bit-reversed since the stream is read lowest bit first.
+    codes = [0] * len(lengths)
+    code = 0
+    for bitLength in range(1, 0x11):
+        for value, length in enumerate(lengths):
+            if length == bitLength:
+                codes[value] = int(f'{code >> (0x10 - bitLength):0{bitLength}b}'[::-1], 2)
+                code += 1 << (0x10 - bitLength)
+    return codes
+
+
 def input_value(bf, table):
-    index = 0
-    while table[index].code != bf.peek_bits(table[index].ln):
-        index += 1
-    bf.read_bits(table[index].ln)
-    value = table[index].value
+    bits, lookup = table
+    entry = lookup[bf.peek_bits(bits)]
+    if entry is None:
+        raise Exception("Bad RNC Format at Huff code")
+    ln, value = entry
+    bf.skip_bits(ln)
     if value >= 2:
         value -= 1
         value = bf.read_bits(value) | (1 << value)
@@ -104,97 +238,301 @@ def input_value(bf, table):
 
 
 def make_huff_table(bf):
+    # Codes are stored bit-reversed, so every index whose low `ln` bits equal
+    # a code belongs to that code, whatever the bits above them are.
     numCodes = bf.read_bits(5)
     if numCodes == 0:
         raise Exception("Bad RNC Format at Huff table")
-    huffLength = [bf.read_bits(4) for _ in range(numCodes)] + [0] * (0x10 - numCodes)
-    table_idx = 0
-    lst = []
-    for bitLength in range(1, 0x11):
-        for k, length in enumerate(huffLength):
-            if length == bitLength:
-                b = table_idx >> (0x10 - bitLength)
-                code = sum(((b >> m) & 1) << (bitLength - m - 1) for m in range(bitLength))
-                table_idx += 1 << (0x10 - bitLength)
-                lst.append(Huff(bitLength, code, k & 0xff))
-    return lst
+    huffLength = [bf.read_bits(4) for _ in range(numCodes)]
+    bits = max(huffLength)
+    lookup = [None] * (1 << bits)
+    for k, (length, code) in enumerate(zip(huffLength, canonical_codes(huffLength))):
+        if length:
+            entry = (length, k & 0xff)
+            for index in range(code, len(lookup), 1 << length):
+                lookup[index] = entry
+    return bits, lookup
 
-def decompress(data: bytes) -> bytes:
+# Matches reach back at most this far, so streaming keeps this much output.
+WINDOW = 0x10000
 
-    header, packed = data[:0x12], data[0x12:]
 
-    if header[:4] != b'RNC\x01':
-        return b''
+class RncHeader(NamedTuple):
+    unpacked_size: int
+    packed_size: int
+    crc_unpacked: int
+    crc_packed: int
+    leeway: int
+    blocks: int
+    method: int
+
+
+def read_header(data) -> RncHeader | None:
+    header = data[:0x12]
+
+    if len(header) < 0x12 or header[:3] != b'RNC' or header[3] not in (1, 2):
+        return None
 
     unpacked_size = int.from_bytes(header[0x4:0x8], 'big')
     packed_size = int.from_bytes(header[0x8:0xC], 'big')
     crc_unpacked = int.from_bytes(header[0xC:0xE], 'big')
     crc_packed = int.from_bytes(header[0xE:0x10], 'big')
 
-    _leeway = header[0x10]
+    leeway = header[0x10]
     blocks = header[0x11]
 
-    assert len(packed) == packed_size, (len(packed), packed_size)
+    return RncHeader(unpacked_size, packed_size, crc_unpacked, crc_packed, leeway, blocks, header[3])
 
-    if calc_crc16(packed) != crc_packed:
-        raise Exception("Bad CRC at packed")
 
-    output = bytearray(unpacked_size)
+def check_packed(data, header: RncHeader) -> bool:
+    # Whether the packed stream is whole and matches its CRC, without
+    # unpacking anything.
+    packed = memoryview(data)[0x12:]
+    return len(packed) == header.packed_size and crc16(packed) == header.crc_packed
 
-    bf = BitBuffer(packed)
-    index = 0
+
+def open_stream(data, header: RncHeader):
+    packed = memoryview(data)[0x12:]
+
+    assert len(packed) == header.packed_size, (len(packed), header.packed_size)
+
+    if crc16(packed) != header.crc_packed:
+        raise Exception("Bad CRC at packed")
+
+    bf = BitReader(packed) if header.method == 1 else BitReaderM2(packed)
     bf.read_bits(2)
+    return bf
+
+
+def unpack_block(bf, output, index):
+    # Decode one block into `output` from `index` on and return where it
+    # ended. A bytearray grows as needed; a memoryview must be big enough.
+    raw_table = make_huff_table(bf)
+    pos_table = make_huff_table(bf)
+    len_table = make_huff_table(bf)
+    counts = bf.read_bits(0x10)
+
+    while counts > 0:
+        inputLength = input_value(bf, raw_table)
+        if inputLength > 0:
+            output[index:index+inputLength] = bf.get_bytes(inputLength)
+            index += inputLength
+        if counts > 1:
+            inputOffset = input_value(bf, pos_table) + 1
+            inputLength = input_value(bf, len_table) + 2
+            copy_match(output, index, inputOffset, inputLength)
+            index += inputLength
+        counts -= 1
+
+    return index
+
+
+def copy_match(output, index, offset, length):
+    start = index - offset
+    if offset >= length:
+        output[index:index+length] = output[start:start+length]
+    else:
+        # The match overlaps its own output: it repeats the last `offset`
+        # bytes, so tile that pattern instead.
+        repeats = length // offset + 1
+        output[index:index+length] = (bytes(output[start:index]) * repeats)[:length]
+
+
+def input_offset_m2(bf):
+    # A 4-bit high part in 1 to 6 bits, then the low byte.
+    high = 0
+    if bf.read_bit():
+        high = bf.read_bit()
+        if bf.read_bit():
+            high = ((high << 1) | bf.read_bit()) | 4
+            if not bf.read_bit():
+                high = (high << 1) | bf.read_bit()
+        elif high == 0:
+            high = bf.read_bit() + 2
+    return ((high << 8) | bf.get_bytes(1)[0]) + 1
+
+
+def unpack_block_m2(bf, output, index):
+    # Method 2 has no tables, just a prefix code per token:
+    #   0           one literal byte
+    #   10b0        match of 4+b bytes
+    #   10b1c       match of (3+b)*2+c bytes, 6 to 8; 9 instead means a run
+    #               of (4 bits << 2) + 12 literal bytes
+    #   110 byte    match of 2 bytes at offset byte+1
+    #   1110        match of 3 bytes
+    #   1111 byte   match of byte+8 bytes; byte 0 ends the block, followed
+    #               by a bit that is set if another block follows
+    read_bit = bf.read_bit
+    while True:
+        if not read_bit():
+            output[index:index+1] = bf.get_bytes(1)
+            index += 1
+            continue
+        if not read_bit():
+            length = 4 + read_bit()
+            if read_bit():
+                length = (length - 1) * 2 + read_bit()
+                if length == 9:
+                    length = (bf.read_bits(4) << 2) + 12
+                    output[index:index+length] = bf.get_bytes(length)
+                    index += length
+                    continue
+            offset = input_offset_m2(bf)
+        elif not read_bit():
+            length = 2
+            offset = bf.get_bytes(1)[0] + 1
+        elif not read_bit():
+            length = 3
+            offset = input_offset_m2(bf)
+        else:
+            length = bf.get_bytes(1)[0] + 8
+            if length == 8:
+                read_bit()
+                return index
+            offset = input_offset_m2(bf)
+        copy_match(output, index, offset, length)
+        index += length
+
+
+def decompress_into(data: bytes, buffer) -> int:
+    # Unpack into the start of a caller-supplied writable buffer and return
+    # the unpacked size, or 0 if `data` is not RNC packed.
+    header = read_header(data)
+    if not header:
+        return 0
+
+    output = memoryview(buffer).cast('B')
+    if len(output) < header.unpacked_size:
+        raise ValueError(f'Buffer of {len(output)} bytes is too small for {header.unpacked_size}')
+    output = output[:header.unpacked_size]
+
+    bf = open_stream(data, header)
+    unpack = unpack_block if header.method == 1 else unpack_block_m2
+    index = 0
+    for _ in range(header.blocks):
+        index = unpack(bf, output, index)
+
+    assert index == header.unpacked_size, (index, header.unpacked_size)
 
-    for _ in range(blocks):
-        raw_table = make_huff_table(bf)
-        pos_table = make_huff_table(bf)
-        len_table = make_huff_table(bf)
-        counts = bf.read_bits(0x10)
-
-        while counts > 0:
-            inputLength = input_value(bf, raw_table)
-            if inputLength > 0:
-                output[index:index+inputLength] = bf.get_bytes(inputLength)
-                index += inputLength
-            if counts > 1:
-                inputOffset = input_value(bf, pos_table) + 1
-                inputLength = input_value(bf, len_table) + 2
-                for _ in range(inputLength):
-                    output[index] = output[index - inputOffset]
-                    index += 1
-            counts -= 1
-
-    assert len(output) == unpacked_size, (len(output), unpacked_size)
-
-    if calc_crc16(output) != crc_unpacked:
+    if crc16(output) != header.crc_unpacked:
         raise Exception("Bad CRC at unpacked")
 
+    return header.unpacked_size
+
+
+def decompress_blocks(data: bytes) -> Iterator[bytes]:
+    # Yield the output one RNC block at a time, holding only the last
+    # WINDOW bytes in memory. CRC errors on the output surface at the end.
+    header = read_header(data)
+    if not header:
+        return
+
+    bf = open_stream(data, header)
+    unpack = unpack_block if header.method == 1 else unpack_block_m2
+    window = bytearray()
+    total = 0
+    crc = 0
+    for _ in range(header.blocks):
+        start = len(window)
+        unpack(bf, window, start)
+        chunk = bytes(window[start:])
+        total += len(chunk)
+        crc = crc16(chunk, crc)
+        yield chunk
+        del window[:max(len(window) - WINDOW, 0)]
+
+    assert total == header.unpacked_size, (total, header.unpacked_size)
+
+    if crc != header.crc_unpacked:
+        raise Exception("Bad CRC at unpacked")
+
+
+def decompress(data: bytes) -> bytes:
+    header = read_header(data)
+    if not header:
+        return b''
+    output = bytearray(header.unpacked_size)
+    decompress_into(data, output)
     return bytes(output)
 
 
-class RNCCompressor:
+def match_length(buf, src, dst, limit):
+    # The first 3 bytes are known to match through the hash chain key.
+    num = 3
+    while num + 64 <= limit and buf[src+num:src+num+64] == buf[dst+num:dst+num+64]:
+        num += 64
+    while num + 8 <= limit and buf[src+num:src+num+8] == buf[dst+num:dst+num+8]:
+        num += 8
+    while num < limit and buf[src+num] == buf[dst+num]:
+        num += 1
+    return num
+
+
+# Compression levels: GREEDY takes the longest match at each position, for
+# quick patch testing. LAZY is the original one-step lookahead. OPTIMAL
+# prices every parse of a block against the block's own Huffman code
+# lengths, for release builds.
+GREEDY = 0
+LAZY = 1
+OPTIMAL = 2
+
+# How many earlier occurrences of a 3-byte prefix find_sequence may try per
+# level. The whole 0x7fff window fits in a chain, so 0x7fff never gives up
+# a match. OPTIMAL searches at every position rather than once per token,
+# so it stops sooner.
+CHAIN_DEPTHS = {GREEDY: 16, LAZY: 0x7fff, OPTIMAL: 0x400}
+
+# Bit length of every 16-bit value, for counting symbols a block at a time.
+BIT_LENGTHS = np.zeros(0x10000, dtype=np.uint8)
+for bits in range(1, 0x11):
+    BIT_LENGTHS[1 << (bits - 1):1 << bits] = bits
 
-    def bit_len(self, value):
-        num = 0
-        while value != 0:
-            value >>= 1
-            num += 1
-            num &= 0xffff
-        return num
+
+class TokenBlock(NamedTuple):
+    # Tuple i is the literals ibuf[raw_start[i]:raw_end[i]] followed by a
+    # match of lens[i] bytes at distance ofs[i]. The last tuple has no match.
+    raw_start: array
+    raw_end: array
+    ofs: array
+    lens: array
+
+
+# OPTIMAL takes matches at least this long without pricing the positions
+# they cover, and only tries every shorter length up to it.
+NICE_LENGTH = 64
+
+
+class RNCCompressor:
+    method = 1
+    bit_buffer = BitBuffer
+    # Farthest distance and longest match the format can store, and the bits
+    # a literal costs on top of its raw length symbol.
+    max_offset = 0x7fff
+    max_length = 0x1000
+    literal_bits = 8
+
+    def __init__(self, level=LAZY, max_chain=None):
+        if level not in CHAIN_DEPTHS:
+            raise ValueError(f'Unknown compression level {level}')
+        self.level = level
+        self.max_chain = CHAIN_DEPTHS[level] if max_chain is None else max_chain
 
     @classmethod
-    def compress(cls, data: bytes) -> bytes:
-        return cls().do_compress(data)
+    def compress(cls, data: bytes, level=LAZY) -> bytes:
+        return cls(level).do_compress(data)
 
     def do_compress(self, unpacked: bytes) -> bytes:
-        output = bytearray(len(unpacked))
-        output[:4] = b'RNC\x01'
+        output = bytearray(0x12 + len(unpacked))
+        output[:4] = b'RNC' + bytes([self.method])
         output[4:8] = len(unpacked).to_bytes(4, 'big')
-        output[12:14] = calc_crc16(unpacked).to_bytes(2, 'big')
-        self.bf = BitBuffer(output, 0x12)
+        output[12:14] = crc16(unpacked).to_bytes(2, 'big')
+        self.bf = self.bit_buffer(output, 0x12)
         self.bf.write_bits(0, 2)
-        self.ibuf = unpacked
+        self.ibuf = bytes(unpacked)
         self.ipos = 0
+        self.head = {}
+        self.prev = [-1] * len(unpacked)
+        self.hpos = 0
 
         num = 0
         while self.ipos < len(self.ibuf):
@@ -205,55 +543,97 @@ class RNCCompressor:
         self.bf.write_end()
         output = output[:self.bf.pos]
         output[8:12] = (len(output) - 0x12).to_bytes(4, 'big')
-        output[14:16] = calc_crc16(output[0x12:]).to_bytes(2, 'big')
+        output[14:16] = crc16(memoryview(output)[0x12:]).to_bytes(2, 'big')
         output[0x10] = 0
         output[0x11] = num
         return bytes(output)
 
+    def start_tokens(self):
+        self.tokens = TokenBlock(array('I', [self.cpos]), array('I', [self.cpos]), array('H'), array('H'))
+        self.tid = 0
+
     def emit_pair(self, ofs, length):
-        tupl = self.get_tuple(self.tup, self.tid)
-        tupl['ofs'] = ofs
-        tupl['len'] = length
-        self.tup[self.tid] = tupl
+        self.tokens.ofs.append(ofs)
+        self.tokens.lens.append(length)
         self.tid += 1
         self.cpos += length
-        self.get_tuple(self.tup, self.tid)
+        self.tokens.raw_start.append(self.cpos)
+        self.tokens.raw_end.append(self.cpos)
 
     def emit_raw(self, length):
-        tupl = self.get_tuple(self.tup, self.tid)
-        tupl['rawdata'] += self.ibuf[self.cpos:self.cpos+length]
-        self.tup[self.tid] = tupl
         self.cpos += length
+        self.tokens.raw_end[-1] = self.cpos
+
+    def insert_hashes(self, pos):
+        # Chain every position before `pos` by the 3 bytes starting there,
+        # so find_sequence only visits candidates that can match at all.
+        ibuf = self.ibuf
+        head = self.head
+        prev = self.prev
+        end = min(pos, len(ibuf) - 2)
+        for i in range(self.hpos, end):
+            key = ibuf[i:i+3]
+            prev[i] = head.get(key, -1)
+            head[key] = i
+        self.hpos = max(self.hpos, end)
+
+    def find_matches(self, pos, maxpos):
+        # Every match longer than the ones nearer to `pos`, as (length,
+        # distance) pairs from nearest to farthest. The last one is the
+        # longest, at the shortest distance that reaches it.
+        matches = []
+        best_len = 2
+        limit = min(maxpos - pos, self.max_length)
+        if pos == 0 or limit < 3:
+            return matches
+        self.insert_hashes(pos)
+        ibuf = self.ibuf
+        prev = self.prev
+        lowest = max(pos - self.max_offset, 0)
+        candidate = self.head.get(ibuf[pos:pos+3], -1)
+        while candidate >= pos:
+            candidate = prev[candidate]
+        depth = self.max_chain
+        while candidate >= lowest and depth > 0:
+            if ibuf[candidate + best_len] == ibuf[pos + best_len]:
+                num = match_length(ibuf, candidate, pos, limit)
+                if num > best_len:
+                    best_len = num
+                    matches.append((num, pos - candidate))
+                    if num >= limit:
+                        break
+            candidate = prev[candidate]
+            depth -= 1
+        return matches
 
     def find_sequence(self, pos, length, maxpos):
         if pos == 0:
             return length, 0
-        num = pos - 0x7fff
-        if num < 0:
-            num = 0
-        num2 = 2
-        num3 = 0
-        num4 = 1
-        num5 = 0
-        while pos - num4 >= num and num2 < 0x1000:
-            num5 = 0
-            index = pos
-            num7 = index - num4
-            while index < maxpos and self.ibuf[index] == self.ibuf[num7] and num5 < 0x1000:
-                index += 1
-                num7 += 1
-                num5 += 1
-            if num5 > num2:
-                num2 = num5
-                num3 = num4
-            num4 += 1
-        return num2, num3
-
-    def get_tuple(self, tup, tid):
-        while len(tup) - 1 < tid:
-            item = {'rawdata': bytearray(), 'ofs': 0, 'len': 0}
-            tup.append(item)
-        return tup[tid]
+        # Chains are ordered nearest first, so the last match found is the
+        # same (length, distance) a full window scan would pick.
+        matches = self.find_matches(pos, maxpos)
+        if not matches:
+            return 2, 0
+        return matches[-1]
+
+    def is_incompressible(self, start, end):
+        # Literals are stored as plain bytes, so only matches save space. If
+        # almost no 3-byte string in the block was seen before, searching for
+        # matches is wasted time.
+        count = end - start - 2
+        if count < 0x100:
+            return False
+        self.insert_hashes(start)
+        ibuf = self.ibuf
+        head = self.head
+        seen = set()
+        repeats = 0
+        for i in range(start, end - 2):
+            key = ibuf[i:i+3]
+            if key in seen or key in head:
+                repeats += 1
+            seen.add(key)
+        return repeats < count >> 6
 
     def isbetter(self, length, no, l, o):
         if length < l:
@@ -261,17 +641,39 @@ class RNCCompressor:
         return (length > l and (no - 0x800) < o) or (length > (l + 1) and (no - 0x1000) < o) or length > (l + 2)
 
     def make_block(self):
-        self.tup = []
-        self.tid = 0
         self.cpos = self.ipos
+        self.start_tokens()
+        maxpos = self.ipos + 0x3000
+        if maxpos > len(self.ibuf):
+            maxpos = len(self.ibuf)
+        if self.is_incompressible(self.ipos, maxpos):
+            self.emit_raw(maxpos - self.cpos)
+        elif self.level == GREEDY:
+            self.parse_greedy(maxpos)
+        elif self.level == OPTIMAL:
+            self.parse_optimal(maxpos)
+        else:
+            self.parse_lazy(maxpos)
+        self.ipos = self.cpos
+        return self.tokens
+
+    def parse_greedy(self, maxpos):
+        while self.cpos < maxpos and self.tid < 0xfff:
+            if maxpos - self.cpos < 3:
+                self.emit_raw(maxpos - self.cpos)
+                continue
+            length, no = self.find_sequence(self.cpos, 0, maxpos)
+            if no > 0:
+                self.emit_pair(no, length)
+            else:
+                self.emit_raw(1)
+
+    def parse_lazy(self, maxpos):
         no = 0
         length = 0
         ln = 0
         l = 0
         o = 0
-        maxpos = self.ipos + 0x3000
-        if maxpos > len(self.ibuf):
-            maxpos = len(self.ibuf)
         while self.cpos < maxpos and self.tid < 0xfff:
             if maxpos - self.cpos < 3:
                 self.emit_raw(maxpos - self.cpos)
@@ -295,99 +697,111 @@ class RNCCompressor:
                     o = no
                 else:
                     self.emit_raw(1)
-        self.ipos = self.cpos
-        return self.tup
+
+    def symbol_costs(self, block):
+        # Bits each raw length and offset would cost in `block`, by bit
+        # length of the stored value, and each match length by itself. Every
+        # symbol gets a code, so values the block did not use are still priced.
+        costs = []
+        for freq in block_frequencies(block) + 1:
+            lengths = huff_lengths(freq.tolist())
+            costs.append([lengths[bits] + max(bits - 1, 0) for bits in range(0x10)])
+        raw_costs, ofs_costs, len_costs = costs
+        len_costs = [0, 0] + [len_costs[(num - 2).bit_length()] for num in range(2, self.max_length + 1)]
+        return raw_costs, ofs_costs, len_costs
+
+    def parse_optimal(self, maxpos):
+        start = self.cpos
+        size = maxpos - start
+
+        # Price symbols from a greedy parse of the same block.
+        self.parse_greedy(maxpos)
+        raw_costs, ofs_costs, len_costs = self.symbol_costs(self.tokens)
+        self.cpos = start
+        self.start_tokens()
+
+        # cost[i]: fewest bits to encode the first i bytes of the block.
+        # run[i]: literals since the last match on that path, whose length
+        # symbol the next match has to pay for.
+        # step[i]: how that path reaches i, 0 for a literal or the match.
+        cost = [0] + [float('inf')] * size
+        run = [0] * (size + 1)
+        step = [0] * (size + 1)
+        skip_to = 0
+        for i in range(size):
+            here = cost[i]
+            if here + self.literal_bits < cost[i + 1]:
+                cost[i + 1] = here + self.literal_bits
+                run[i + 1] = run[i] + 1
+                step[i + 1] = 0
+            if i < skip_to:
+                continue
+            matches = self.find_matches(start + i, maxpos)
+            if not matches:
+                continue
+            base = here + raw_costs[run[i].bit_length()]
+            shortest = min(matches[0][0], 3)
+            for length, distance in matches:
+                price = base + ofs_costs[(distance - 1).bit_length()]
+                tried = range(shortest, min(length, NICE_LENGTH) + 1)
+                if length > NICE_LENGTH:
+                    tried = [*tried, length]
+                for num in tried:
+                    total = price + len_costs[num]
+                    if total < cost[i + num]:
+                        cost[i + num] = total
+                        run[i + num] = 0
+                        step[i + num] = (num, distance)
+                shortest = length + 1
+            if matches[-1][0] >= NICE_LENGTH:
+                skip_to = i + matches[-1][0]
+
+        path = []
+        i = size
+        while i > 0:
+            path.append(step[i])
+            i -= step[i][0] if step[i] else 1
+        literals = 0
+        for item in reversed(path):
+            if not item:
+                literals += 1
+                continue
+            if self.tid >= 0xfff:
+                break
+            self.emit_raw(literals)
+            literals = 0
+            length, distance = item
+            self.emit_pair(distance, length)
+        else:
+            self.emit_raw(literals)
 
     def make_huff_table(self, freq):
-        nodeArray = [None] * 0x20
-        lst = []
-        index = 0
-        for i in range(0x10):
-            if freq[i] > 0:
-                nodeArray[index] = {'freq': freq[i], 'parent': -1, 'lchild': -1, 'rchild': i}
-                index += 1
-        num3 = index
-        if num3 == 1:
-            num3 = 2
-        while num3 > 1:
-            num4 = 0x7ffffffe
-            num5 = 0x7fffffff
-            num6 = 0
-            num7 = 0
-            for num8 in range(index):
-                if nodeArray[num8]['parent'] == -1:
-                    if num4 > nodeArray[num8]['freq']:
-                        num5 = num4
-                        num7 = num6
-                        num4 = nodeArray[num8]['freq']
-                        num6 = num8
-                    elif num5 > nodeArray[num8]['freq']:
-                        num5 = nodeArray[num8]['freq']
-                        num7 = num8
-            nodeArray[index] = {'freq': num4 + num5, 'parent': -1, 'lchild': num6, 'rchild': num7}
-            nodeArray[num6]['parent'] = nodeArray[num7]['parent'] = index
-            index += 1
-            num3 -= 1
-        num9 = 0
-        for j in range(0x10):
-            lst.append(Huff(0, 0, 0))
-        for k in range(index):
-            if nodeArray[k]['lchild'] == -1:
-                num12 = 0
-                num3 = k
-                while nodeArray[num3]['parent'] != -1:
-                    num12 += 1
-                    num3 = nodeArray[num3]['parent']
-                huff = lst[nodeArray[k]['rchild']]
-                huff.value = nodeArray[k]['rchild'] & 0xffff
-                huff.ln = num12 & 0xff
-                lst[nodeArray[k]['rchild']] = huff
-                if num9 < num12:
-                    num9 = num12
-        num13 = 0
-        for m in range(1, num9 + 1):
-            for index in range(0x10):
-                if lst[index].ln == m:
-                    num15 = (num13 >> (0x10 - m)) & 0xffff
-                    num16 = 0
-                    for num17 in range(m):
-                        num16 |= ((num15 >> num17) & 1) << (m - num17 - 1)
-                        num16 &= 0xffff
-                    huff2 = lst[index]
-                    huff2.code = num16
-                    lst[index] = huff2
-                    num13 += 1 << (0x10 - m)
-                    num13 &= 0xffff
-        n = len(lst) - 1
-        while lst[n].ln == 0 and len(lst) > 1:
-            lst.pop(n)
-            n -= 1
+        lengths = huff_lengths(freq)
+        lst = [Huff(ln, code, value) for value, (ln, code) in enumerate(zip(lengths, canonical_codes(lengths)))]
+        while len(lst) > 1 and lst[-1].ln == 0:
+            lst.pop()
         return lst
 
     def write_block(self, block):
-        freq = [0] * 0x10
-        for item in block:
-            freq[self.bit_len(len(item['rawdata']))] += 1
-        table = self.make_huff_table(freq)
+        raw_freq, ofs_freq, len_freq = block_frequencies(block).tolist()
+        table = self.make_huff_table(raw_freq)
         self.write_huff(table)
-        freq = [0] * 0x10
-        for item in block[:-1]:
-            freq[self.bit_len(item['ofs'] - 1)] += 1
-        huff_array2 = self.make_huff_table(freq)
+        huff_array2 = self.make_huff_table(ofs_freq)
         self.write_huff(huff_array2)
-        freq = [0] * 0x10
-        for item in block[:-1]:
-            freq[self.bit_len(item['len'] - 2)] += 1
-        huff_array3 = self.make_huff_table(freq)
+        huff_array3 = self.make_huff_table(len_freq)
         self.write_huff(huff_array3)
-        self.bf.write_bits(len(block), 0x10)
-        for num7 in range(len(block)):
-            self.write_huff_value(table, len(block[num7]['rawdata']))
-            if len(block[num7]['rawdata']) > 0:
-                self.bf.write_bytes(block[num7]['rawdata'])
-            if num7 < len(block) - 1:
-                self.write_huff_value(huff_array2, block[num7]['ofs'] - 1)
-                self.write_huff_value(huff_array3, block[num7]['len'] - 2)
+        raw_start, raw_end, ofs, lens = block
+        self.bf.write_bits(len(raw_start), 0x10)
+        ibuf = memoryview(self.ibuf)
+        for num7 in range(len(raw_start)):
+            start = raw_start[num7]
+            end = raw_end[num7]
+            self.write_huff_value(table, end - start)
+            if end > start:
+                self.bf.write_bytes(ibuf[start:end])
+            if num7 < len(ofs):
+                self.write_huff_value(huff_array2, ofs[num7] - 1)
+                self.write_huff_value(huff_array3, lens[num7] - 2)
 
     def write_huff(self, table):
         self.bf.write_bits(len(table), 5)
@@ -395,7 +809,127 @@ class RNCCompressor:
             self.bf.write_bits(item.ln, 4)
 
     def write_huff_value(self, table, value):
-        index = self.bit_len(value)
+        index = value.bit_length()
         self.bf.write_bits(table[index].code, table[index].ln)
         if index > 1:
             self.bf.write_bits(value, index - 1)
+
+
+# Prefix code for the high 4 bits of a method 2 offset, as (code, bits).
+OFFSET_CODES_M2 = [(0b0, 1), (0b110, 3), (0b1000, 4), (0b1001, 4)]
+OFFSET_CODES_M2 += [(0b10101 | (high & 2) << 2 | (high & 1) << 1, 5) for high in range(4, 8)]
+OFFSET_CODES_M2 += [(0b101000 | (high & 4) << 2 | (high & 2) << 1 | high & 1, 6) for high in range(8, 0x10)]
+
+
+class RNCCompressorM2(RNCCompressor):
+    # Method 2: the same parsing, written with the fixed codes of
+    # unpack_block_m2. It packs a little worse than method 1 but unpacks
+    # faster, as there are no tables to build and no values to look up.
+    method = 2
+    bit_buffer = BitBufferM2
+    max_offset = 0x1000
+    max_length = 0xff + 8
+    literal_bits = 9
+
+    def find_matches(self, pos, maxpos):
+        # Only method 2 can store 2-byte matches, within 0x100 bytes.
+        matches = super().find_matches(pos, maxpos)
+        if not matches and pos > 0 and maxpos - pos >= 2:
+            candidate = self.ibuf.rfind(self.ibuf[pos:pos+2], max(pos - 0x100, 0), pos + 1)
+            if candidate >= 0:
+                matches.append((2, pos - candidate))
+        return matches
+
+    def symbol_costs(self, block):
+        raw_costs = [0] * 0x10
+        # By bit length, offsets up to 0x100 have a high part of 0, then 1,
+        # 2 to 3, 4 to 7 and 8 to 15.
+        ofs_costs = [OFFSET_CODES_M2[min(1 << bits >> 9, 0xf)][1] + 8 for bits in range(0x10)]
+        # A 2-byte match writes its offset byte without the 1-bit high part
+        # that ofs_costs counts, so take that bit off its 3-bit code.
+        len_costs = [0, 0, 2, 4, 4, 4, 5, 5, 5] + [12] * (self.max_length - 8)
+        return raw_costs, ofs_costs, len_costs
+
+    def write_block(self, block):
+        raw_start, raw_end, ofs, lens = block
+        ibuf = memoryview(self.ibuf)
+        for num7 in range(len(raw_start)):
+            self.write_literals(ibuf[raw_start[num7]:raw_end[num7]])
+            if num7 < len(ofs):
+                self.write_match(ofs[num7], lens[num7])
+        self.bf.write_bits(0b1111, 4)
+        self.bf.write_bytes(b'\0')
+        self.bf.write_bits(self.ipos < len(self.ibuf), 1)
+
+    def write_literals(self, data):
+        start = 0
+        while len(data) - start >= 12:
+            length = min(len(data) - start, 72) & ~3
+            self.bf.write_bits(0b10111, 5)
+            self.bf.write_bits((length - 12) >> 2, 4)
+            self.bf.write_bytes(data[start:start+length])
+            start += length
+        for num in range(start, len(data)):
+            self.bf.write_bits(0, 1)
+            self.bf.write_bytes(data[num:num+1])
+
+    def write_match(self, distance, length):
+        if length == 2:
+            self.bf.write_bits(0b110, 3)
+            self.bf.write_bytes(bytes([distance - 1]))
+            return
+        if length == 3:
+            self.bf.write_bits(0b1110, 4)
+        elif length <= 5:
+            self.bf.write_bits(0b1000 | (length - 4) << 1, 4)
+        elif length <= 8:
+            self.bf.write_bits(0b10010 | (length // 2 - 3) << 2 | length & 1, 5)
+        else:
+            self.bf.write_bits(0b1111, 4)
+            self.bf.write_bytes(bytes([length - 8]))
+        code, bits = OFFSET_CODES_M2[(distance - 1) >> 8]
+        self.bf.write_bits(code, bits)
+        self.bf.write_bytes(bytes([(distance - 1) & 0xff]))
+
+
+COMPRESSORS = {1: RNCCompressor, 2: RNCCompressorM2}
+
+
+def block_frequencies(block):
+    # Symbol counts for the raw length, offset and match length tables, as
+    # rows of one (3, 16) array.
+    raw_start, raw_end, ofs, lens = (np.asarray(item) for item in block)
+    symbols = np.concatenate((
+        BIT_LENGTHS[raw_end - raw_start],
+        BIT_LENGTHS[ofs - 1] + 0x10,
+        BIT_LENGTHS[lens - 2] + 0x20,
+    ))
+    return np.bincount(symbols, minlength=0x30).reshape(3, 0x10)
+
+
+def compress(data: bytes, level=LAZY, method=1) -> bytes:
+    # Method 2 is not read by the game, which only has the method 1 decoder.
+    if method not in COMPRESSORS:
+        raise ValueError(f'Unknown RNC method {method}')
+    return COMPRESSORS[method].compress(data, level)
+
+
+def run_many(func, payloads, workers=None, chunksize=1):
+    # Results come back in the order of `payloads`. workers=1 runs in this
+    # process, which is easier to debug and skips the pool start-up cost.
+    payloads = list(payloads)
+    if workers == 1 or len(payloads) < 2:
+        return [func(payload) for payload in payloads]
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        return list(executor.map(func, payloads, chunksize=chunksize))
+
+
+def compress_many(payloads, level=LAZY, workers=None, chunksize=1, method=1, cache=None):
+    # `cache` is an rnc_cache.CompressionCache to reuse earlier results from.
+    if cache is not None:
+        return cache.compress_many(payloads, level, workers, chunksize, method)
+    return run_many(functools.partial(compress, level=level, method=method), payloads, workers, chunksize)
+
+
+def decompress_many(payloads, workers=None, chunksize=1):
+    return run_many(decompress, payloads, workers, chunksize)
@@ -1,5 +1,8 @@
+import hashlib
 import pathlib
+from typing import NamedTuple
 
+import numpy as np
 from PIL import Image
 
 import disk
@@ -42,78 +45,277 @@ def image_from_buffer(buffer, palette):
     return im
 
 
-def load_flirt(data, buffer):
-    frames_left, *seq_data = data
-    screen = bytearray(buffer)
-    pos = 0
-    start = 0
+# Frames cover the top 192 rows of the 320x200 screen.
+FRAME_SIZE = 320 * 192
+
+
+def load_flirt(data, buffer, start=0, index=None):
+    # The frame's part of the sequence as a list and a copy of the screen
+    # after it, for each frame from `start` on. iter_flirt and decode_flirt
+    # do without the copies.
+    for (begin, end), frame in iter_flirt(data, buffer, start=start, index=index):
+        yield list(data[begin:end]), bytes(frame)
 
-    for _ in range(frames_left):
-        screen_pos = 0
-        while screen_pos < 320 * 192:
 
-            nr_to_skip = seq_data[pos]
+def decode_frame(seq, pos, screen):
+    # Apply the frame starting at seq[pos] to the flat `screen` buffer and
+    # return where the next frame starts. Like the game, read a whole chain
+    # of 0xFF skips and then the counts after it before checking whether
+    # the frame is done.
+    screen_pos = 0
+    while screen_pos < FRAME_SIZE:
+        while True:
+            nr_to_skip = seq[pos]
             pos += 1
             screen_pos += nr_to_skip
-            if nr_to_skip == 0xFF:
-                continue
+            if nr_to_skip != 0xFF:
+                break
 
-            while True:
-                nr_to_do = seq_data[pos]
-                pos += 1
+        while True:
+            nr_to_do = seq[pos]
+            pos += 1
 
-                screen[screen_pos:screen_pos+nr_to_do] = seq_data[pos:pos+nr_to_do]
-                pos += nr_to_do
-                screen_pos += nr_to_do
+            screen[screen_pos:screen_pos+nr_to_do] = seq[pos:pos+nr_to_do]
+            pos += nr_to_do
+            screen_pos += nr_to_do
 
-                if nr_to_do != 0xFF:
-                    break
+            if nr_to_do != 0xFF:
+                break
 
-        yield seq_data[start:pos], bytes(screen)
-        start = pos
+    return pos
 
 
-def pack_flirt(screens):
+def iter_flirt(data, buffer, numpy=False, start=0, index=None):
+    # Decode into one framebuffer and yield ((start, end), frame) per frame:
+    # data[start:end] is the frame's part of the sequence and `frame` is a
+    # read-only memoryview, or a (200, 320) array with numpy=True, of the
+    # framebuffer. Frames are only valid until the next one is decoded.
+    # Frames before `start` are not yielded; with a FlirtIndex of the same
+    # data and buffer, at most index.interval - 1 of them are decoded.
+    seq = memoryview(data).cast('B')
+    screen = bytearray(buffer)
+    view = memoryview(screen)
+    if numpy:
+        frame = np.frombuffer(screen, dtype=np.uint8).reshape(200, 320)
+        frame.flags.writeable = False
+    else:
+        frame = view.toreadonly()
+
+    pos = 1
+    first = 0
+    if index is not None and start > 0:
+        checkpoint = min(start // index.interval, len(index.offsets) - 1)
+        view[:] = index.snapshots[checkpoint].tobytes()
+        pos = int(index.offsets[checkpoint])
+        first = checkpoint * index.interval
+
+    for num in range(first, seq[0]):
+        end = decode_frame(seq, pos, view)
+        if num >= start:
+            yield (pos, end), frame
+        pos = end
+
+
+def decode_flirt(data, buffer, out=None):
+    # Every frame of the sequence into an (N, 200, 320) array, `out` if
+    # given, for exporting all of them.
+    seq = memoryview(data).cast('B')
+    frames = seq[0]
+    if out is None:
+        out = np.empty((frames, 200, 320), dtype=np.uint8)
+    assert out.shape[0] >= frames and out.shape[1:] == (200, 320) and out.flags.c_contiguous, out.shape
+
+    previous = np.frombuffer(buffer, dtype=np.uint8).reshape(200, 320)
+    pos = 1
+    for num in range(frames):
+        out[num] = previous
+        pos = decode_frame(seq, pos, memoryview(out[num]).cast('B'))
+        previous = out[num]
+    return out
+
+
+class FlirtIndex(NamedTuple):
+    # Checkpoint i is where frame i * interval starts in the sequence data
+    # and the screen just before it.
+    interval: int
+    offsets: np.ndarray
+    snapshots: np.ndarray
+
+
+def build_flirt_index(data, buffer, interval=16):
+    seq = memoryview(data).cast('B')
+    frames = seq[0]
+    offsets = []
+    snapshots = []
+    screen = bytearray(buffer)
+    view = memoryview(screen)
+    pos = 1
+    for num in range(frames):
+        if num % interval == 0:
+            offsets.append(pos)
+            snapshots.append(np.frombuffer(screen, dtype=np.uint8).reshape(200, 320).copy())
+        pos = decode_frame(seq, pos, view)
+    if not snapshots:
+        snapshots.append(np.frombuffer(screen, dtype=np.uint8).reshape(200, 320).copy())
+        offsets.append(pos)
+    return FlirtIndex(interval, np.array(offsets, dtype=np.uint32), np.stack(snapshots))
+
+
+def flirt_index(data, buffer, interval=16, cache_dir='.flirt_cache'):
+    # build_flirt_index, kept in `cache_dir` under a hash of everything the
+    # index depends on. cache_dir=None only builds it.
+    if cache_dir is None:
+        return build_flirt_index(data, buffer, interval)
+
+    key = hashlib.sha256(bytes(data) + bytes(buffer) + interval.to_bytes(4, 'little')).hexdigest()
+    path = pathlib.Path(cache_dir) / f'{key}.npz'
+    if path.exists():
+        with np.load(path) as cached:
+            return FlirtIndex(int(cached['interval']), cached['offsets'], cached['snapshots'])
+
+    index = build_flirt_index(data, buffer, interval)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp = path.with_name(path.name + '.tmp.npz')
+    np.savez_compressed(temp, **index._asdict())
+    temp.replace(path)
+    return index
+
+
+def flirt_frame(data, buffer, num, index=None):
+    # A copy of frame `num` as a (200, 320) array.
+    for _, frame in iter_flirt(data, buffer, numpy=True, start=num, index=index):
+        return frame.copy()
+    raise IndexError(f'Frame {num} of {data[0]}')
+
+
+def frame_runs(screen, buffer):
+    # A frame as skip and literal counts: runs of pixels that stay as in
+    # `buffer`, each followed by the run of changed pixels after it. Both
+    # arrays are uint8 NumPy views.
+    changed = screen[:FRAME_SIZE] != buffer[:FRAME_SIZE]
+    edges = np.flatnonzero(np.diff(changed)) + 1
+    runs = np.diff(np.concatenate(([0], edges, [FRAME_SIZE])))
+    # Pair the runs up: start with a kept run and end with a changed one,
+    # either of which can be empty.
+    if changed[0]:
+        runs = np.concatenate(([0], runs))
+    if len(runs) % 2:
+        runs = np.append(runs, 0)
+    return runs[0::2], runs[1::2]
+
+
+def pack_runs(screen, skips, literals, chunks):
+    # The bytes of a frame of (skip, literal) pairs, where the literal of
+    # pair i is split into chunks[i] pieces of 0xFF and 255 pixels, then a
+    # count of the pixels that are left and those pixels.
+    pairs = np.arange(len(skips))
+    at = np.cumsum(literals) - literals
+
+    # Count bytes go in between the literal pixels, at `at` for the counts
+    # that come before pair i's pixels. A skip of n is n // 255 bytes of
+    # 0xFF and the rest.
+    skip_ffs = skips // 255
+    chunk_pairs = np.repeat(pairs, chunks + 1)
+    chunk = np.arange(len(chunk_pairs)) - np.repeat(np.cumsum(chunks + 1) - chunks - 1, chunks + 1)
+    last = chunk == chunks[chunk_pairs]
+
+    index = np.concatenate((np.repeat(at, skip_ffs), at, at[chunk_pairs] + 255 * chunk))
+    value = np.concatenate((
+        np.full(skip_ffs.sum(), 0xFF),
+        skips % 255,
+        np.where(last, literals[chunk_pairs] - 255 * chunk, 0xFF),
+    ))
+    # np.insert keeps equal indices in the order given, so sort by pair and
+    # then by place within the pair.
+    pair = np.concatenate((np.repeat(pairs, skip_ffs), pairs, chunk_pairs))
+    place = np.concatenate((np.zeros(skip_ffs.sum(), dtype=int), np.ones(len(pairs), dtype=int), chunk + 2))
+    order = np.lexsort((place, pair))
+
+    in_literal = np.repeat(np.tile([False, True], len(pairs)), np.column_stack((skips, literals)).ravel())
+    pixels = screen[:FRAME_SIZE][in_literal]
+    return np.insert(pixels, index[order], value[order].astype(np.uint8)).tobytes()
+
+
+def pack_frame(screen, buffer):
+    # A literal run of n > 255 is split into 0xFF and 255 pixels as long as
+    # more than 255 are left, so n = 255 * m ends in a count of 255 that
+    # the game takes for one more chunk. Kept as it is to match existing
+    # sequences byte for byte; see pack_frame_optimal.
+    skips, literals = frame_runs(screen, buffer)
+    chunks = np.maximum(literals - 1, 0) // 255
+
+    for _ in range(chunks.sum()):
+        print('warning: nr_to_do > 255')
+
+    return pack_runs(screen, skips, literals, chunks)
+
+
+def merge_runs(skips, literals):
+    # Rewrite the pairs of frame_runs to fewest bytes by copying some runs
+    # of unchanged pixels as part of the literals around them.
+    #
+    # A pair costs skip // 255 + 1 + literal // 255 + 1 + literal bytes.
+    # Going through the runs in order, the best encoding so far ends in an
+    # open literal whose later cost only depends on its length mod 255. Of
+    # two such encodings, the cheaper one is never worse by more than its
+    # one next 0xFF byte, and of equal ones the smaller remainder is never
+    # worse, so keeping the least (cost, remainder) alone is exact.
+    skips = skips.tolist()
+    literals = literals.tolist()
+    if literals[-1] == 0 and len(literals) == 1:
+        return np.array(skips), np.array(literals)
+
+    trailing = 0
+    if literals[-1] == 0:
+        trailing = skips.pop()
+        literals.pop()
+
+    cost = skips[0] // 255 + 1 + literals[0] // 255 + 1 + literals[0]
+    remainder = literals[0] % 255
+    joined = [False] * len(skips)
+    for num in range(1, len(skips)):
+        grown = remainder + skips[num] + literals[num]
+        join = (cost + skips[num] + literals[num] + grown // 255, grown % 255)
+        split = (cost + skips[num] // 255 + 1 + literals[num] // 255 + 1 + literals[num], literals[num] % 255)
+        joined[num] = join < split
+        cost, remainder = min(join, split)
+
+    merged_skips = [skips[0]]
+    merged_literals = [literals[0]]
+    for num in range(1, len(skips)):
+        if joined[num]:
+            merged_literals[-1] += skips[num] + literals[num]
+        else:
+            merged_skips.append(skips[num])
+            merged_literals.append(literals[num])
+
+    # Unchanged pixels at the end take a last pair with an empty literal,
+    # unless copying them is cheaper.
+    if trailing:
+        if trailing + (remainder + trailing) // 255 < trailing // 255 + 2:
+            merged_literals[-1] += trailing
+        else:
+            merged_skips.append(trailing)
+            merged_literals.append(0)
+
+    return np.array(merged_skips), np.array(merged_literals)
+
+
+def pack_frame_optimal(screen, buffer):
+    # The smallest encoding of a frame. Literal runs of any length end in a
+    # count below 255, which is 0 for n = 255 * m.
+    skips, literals = merge_runs(*frame_runs(screen, buffer))
+    return pack_runs(screen, skips, literals, literals // 255)
+
+
+def pack_flirt(screens, optimize=False):
+    # `optimize` writes the smallest sequence instead of the one the game's
+    # own sequences were made with.
+    pack = pack_frame_optimal if optimize else pack_frame
     frames_left = len(screens) - 1
-    seq_data = []
-    buffer = screens[0]
-
-    for screen in screens[1:]:
-        screen_pos = 0
-        while screen_pos < 320*192:
-            # Find the longest sequence of same bytes
-            nr_to_skip = 0
-            while screen[screen_pos] == buffer[screen_pos] and screen_pos < 320*192:
-                nr_to_skip += 1
-                screen_pos += 1
-
-            while nr_to_skip >= 255:
-                seq_data.append(0xFF)
-                nr_to_skip -= 255
-
-            seq_data.append(nr_to_skip)
-
-            nr_to_do = 0
-            change_buffer = []
-            while screen[screen_pos] != buffer[screen_pos] and screen_pos < 320*192:
-                change_buffer.append(screen[screen_pos])
-                screen_pos += 1
-                nr_to_do += 1
-
-            assert nr_to_do == len(change_buffer), (nr_to_do, len(change_buffer))
-            while nr_to_do > 255:
-                print('warning: nr_to_do > 255')
-                seq_data.append(0xFF)
-                seq_data.extend(change_buffer[:255])
-                change_buffer = change_buffer[255:]
-                nr_to_do -= 255
-
-            seq_data.append(nr_to_do)
-            seq_data.extend(change_buffer)
-
-        buffer = screen
-
-    return bytes([frames_left] + seq_data)
+    frames = [np.frombuffer(screen, dtype=np.uint8) for screen in screens]
+    seq_data = [pack(screen, buffer) for buffer, screen in zip(frames, frames[1:])]
+    return bytes([frames_left]) + b''.join(seq_data)
 
 
 SEQUENTIAL = True
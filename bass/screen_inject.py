@@ -3,6 +3,7 @@ import pathlib
 from PIL import Image
 
 import disk
+from rnc_cache import CompressionCache
 from screen import convert_palette, image_from_buffer, load_flirt, pack_flirt
 
 
@@ -41,7 +42,7 @@ if __name__ == '__main__':
                 screens.append(im.tobytes())
 
             im = image_from_buffer(first_screen, palette)
-            test_data = pack_flirt(screens)
+            test_data = pack_flirt(screens, optimize=True)
             dsk.patch_file(flrt_file, test_data)
             pathlib.Path(f'{flrt_file}.bin').write_bytes(test_data)
             for idx, (seqa, screen) in enumerate(load_flirt(test_data, bytearray(im.tobytes()))):
@@ -49,4 +50,4 @@ if __name__ == '__main__':
                 im = image_from_buffer(screen, palette)
                 im.save(graphics_dir / f'{flrt_file}.bin-{idx:03d}-again.png')
 
-        dsk.save_as('sky.dsk')
+        dsk.save_in_place(recompress=True, cache=CompressionCache())